@@ -29,13 +29,23 @@ import base64
 import socket
 import struct
 import ssl
-import time
 import sys
 import errno
 import logging
+import os
+import fcntl
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from BaseHTTPServer import BaseHTTPRequestHandler
 from StringIO import StringIO
-from select import select
+import select
+
+# numpy unmasks whole payloads at once, without it we do it byte by byte
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 
 class HTTPRequest(BaseHTTPRequestHandler):
@@ -102,11 +112,29 @@ class WebSocket(object):
 		self.request = None
 		self.usingssl = False
 
+		# data waiting for the socket to be writable, flushed by the server
+		self.sendqueue = deque()
+		self.sendqueuesize = 0
+		self.sendpending = False
+		# sending failed (queue full, socket error), the server is closing the connection
+		self.sendfailed = False
+
+		# rfc 6455 frames are read with recv_into straight into this buffer (allocated after the handshake),
+		# unmasked in place and handed to handleMessage as a memoryview of it: self.data is only valid
+		# during handleMessage, unless the handler takes the buffer with keepData
+		self.recvbuffer = None
+		self.recvlength = 0
+		self.recvsize = 65536
+		# buffers given back with releaseData, reused instead of allocating new ones
+		self.sparebuffers = []
+		self.maxsparebuffers = 2
+
 		self.state = self.HEADERB1
 	
 		# restrict the size of header and payload for security reasons
 		self.maxheader = 65536
 		self.maxpayload = 4194304
+		self.maxsendqueue = 4194304
 
 	def close(self):
 		self.client.close()
@@ -117,6 +145,10 @@ class WebSocket(object):
 		self.hixie76 = False
 		self.headertoread = 2048 
 		self.headerbuffer = ''
+		self.recvbuffer = None
+		self.recvlength = 0
+		self.sendqueue.clear()
+		self.sendqueuesize = 0
 		self.data = ''
 
 
@@ -129,6 +161,26 @@ class WebSocket(object):
 	def handleClose(self):
 		pass
 
+	def keepData(self):
+		# called from handleMessage to keep self.data once it returns: the receive buffer holding it is
+		# handed over and the connection goes on reading into a spare one
+		# returns that buffer, to give back with releaseData when self.data is not needed anymore
+		# (hixie76 messages are never overwritten, None is returned)
+		if self.hixie76 is True:
+			return None
+
+		buff = self.recvbuffer
+		if self.sparebuffers:
+			self.recvbuffer = self.sparebuffers.pop()
+		else:
+			self.recvbuffer = bytearray(len(buff))
+		return buff
+
+	def releaseData(self, buff):
+		# buff from keepData, nothing may use the data it held anymore
+		if buff is not None and len(self.sparebuffers) < self.maxsparebuffers:
+			self.sparebuffers.append(buff)
+
 	def handlePacket(self):
 		# close
 		if self.opcode == self.CLOSE:
@@ -214,14 +266,14 @@ class WebSocket(object):
 				raise Exception("remote socket closed")
 				
 		# else do normal data		
+		elif self.hixie76 is False:
+			self.receiveFrames()
+
 		else:
-			data = self.client.recv(2048)
+			data = self.client.recv(self.recvsize)
 			if data:
 				for val in data:
-					if self.hixie76 is False:
-						self.parseMessage(ord(val))
-					else:
-						self.parseMessage_hixie76(ord(val))
+					self.parseMessage_hixie76(ord(val))
 			else:
 				raise Exception("remote socket closed")
 	
@@ -272,30 +324,78 @@ class WebSocket(object):
 			pass
 
 	def sendBuffer(self, buff):
-		size = len(buff)
-		tosend = size
-		index = 0
+		# queue buff and send as much as the socket takes right now, never blocks
+		# the rest goes out from flushSend when the server sees the socket writable again
+		if len(buff) == 0 or self.sendfailed:
+			return
 
-		while tosend > 0:
-			try:
-				# i should be able to send a bytearray
-				sent = self.client.send(str(buff[index:size]))
-				if sent == 0:
-					raise RuntimeError("socket connection broken")
+		# a client that does not read its data would make us queue forever, it is closed instead
+		if self.sendqueuesize + len(buff) > self.maxsendqueue:
+			self.failSend('send queue exceeded allowable size')
+			return
 
-				index += sent
-				tosend -= sent
+		self.sendqueue.append(buff)
+		self.sendqueuesize += len(buff)
+
+		if len(self.sendqueue) == 1:
+			try:
+				self.flushSend()
+			except Exception as n:
+				self.failSend(str(n))
+
+
+	def failSend(self, reason):
+		# nothing more is sent to this client, the server closes the connection from its loop
+		# sendBuffer is called from anywhere (handleMessage, callbacks of the workers...), raising there
+		# would not always reach the server
+		logging.debug(str(self.address) + ' ' + reason)
+		self.sendfailed = True
+		self.sendqueue.clear()
+		self.sendqueuesize = 0
+		self.server.dropConnection(self)
+
+
+	def flushSend(self):
+		# send queued data until the socket buffer is full, returns True when everything was sent
+		while self.sendqueue:
+			buff = self.sendqueue[0]
+			try:
+				sent = self.client.send(buff)
 
 			except socket.error as e:
-				# if we have full buffers then wait for them to drain and try again
-				if e.errno == errno.EAGAIN:
-					time.sleep(0.001)
-				else:
-					raise e
+				# full buffers, wait until the server sees the socket writable
+				if isinstance(e, ssl.SSLError):
+					if e.errno in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+						break
+				elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise e
+
+			if sent == 0:
+				raise RuntimeError("socket connection broken")
+
+			self.sendqueuesize -= sent
+			if sent < len(buff):
+				self.sendqueue[0] = memoryview(buff)[sent:]
+			else:
+				self.sendqueue.popleft()
+
+		pending = len(self.sendqueue) > 0
+		if pending != self.sendpending:
+			self.sendpending = pending
+			self.server.watchWritable(self, pending)
+
+		return not pending
 
 	
 	#if s is a string then websocket TEXT is sent else BINARY
+	#s can also be a list of buffers (a header and an image...) sent as one BINARY message without joining them first
 	def sendMessage(self, s):
+
+		if isinstance(s, list):
+			parts = s
+		else:
+			parts = [s]
 		
 		if self.hixie76 is False:
 
@@ -308,7 +408,9 @@ class WebSocket(object):
 				header.append(0x82)
 
 			b2 = 0		
-			length = len(s)
+			length = 0
+			for part in parts:
+				length += len(part)
 
 			if length <= 125:
 				b2 |= length
@@ -324,17 +426,22 @@ class WebSocket(object):
 				header.append(b2)
 				header.extend(struct.pack("!Q", length))
 		
+			# header and payload leave together in a single send
+			for part in parts:
+				if isinstance(part, (str, bytearray)):
+					header += part
+				else:
+					header += memoryview(part)
+
 			self.sendBuffer(header)
 			header = None
 
-			if length > 0:
-				self.sendBuffer(s)
-
 		else:
 			msg = bytearray()			
 			msg.append(0)
-			if len(s) > 0:
-				msg.extend(str(s).encode("UTF8"))
+			for part in parts:
+				if len(part) > 0:
+					msg.extend(str(part).encode("UTF8"))
 			msg.append(0xFF)
 
 			self.sendBuffer(msg)
@@ -364,265 +471,611 @@ class WebSocket(object):
 					raise Exception('payload exceeded allowable size')
 
 
-	def parseMessage(self, byte):	
-		# read in the header
-		if self.state == self.HEADERB1:
-			# fin
-			self.fin = (byte & 0x80)
-			# get opcode
-			self.opcode = (byte & 0x0F)
-			
-			self.state = self.HEADERB2
-		
-		elif self.state == self.HEADERB2:
-			mask = byte & 0x80				
-			length = byte & 0x7F
-			
-			if mask == 128:
-				self.hasmask = True
-			else:
-				self.hasmask = False
-			
-			if length <= 125:
-				self.length = length
-				
-				# if we have a mask we must read it
-				if self.hasmask is True:
-					self.maskarray = bytearray()
-					self.state = self.MASK
-				else:
-					# if there is no mask and no payload we are done
-					if self.length <= 0:
-						try:
-							self.handlePacket()
-						finally:
-							self.state = self.HEADERB1
-							self.data = None
-							
-					# we have no mask and some payload
-					else:
-						self.index = 0
-						self.data = bytearray()
-						self.state = self.PAYLOAD
-					
-			elif length == 126:
-				self.lengtharray = bytearray()
-				self.state = self.LENGTHSHORT
-				
-			elif length == 127:
-				self.lengtharray = bytearray()
-				self.state = self.LENGTHLONG
-
-		
-		elif self.state == self.LENGTHSHORT:
-			self.lengtharray.append(byte)
+	def receiveFrames(self):
+		# reads after the bytes already in the receive buffer, without any intermediate string
+		if self.recvbuffer is None:
+			self.recvbuffer = bytearray(self.recvsize)
 
-			if len(self.lengtharray) > 2:
-				raise Exception('short length exceeded allowable size')
+		read = self.client.recv_into(memoryview(self.recvbuffer)[self.recvlength:])
+		if read == 0:
+			raise Exception("remote socket closed")
 
-			if len(self.lengtharray) == 2:
-				self.length = struct.unpack_from('!H', str(self.lengtharray))[0]
-				
-				if self.hasmask is True:
-					self.maskarray = bytearray()
-					self.state = self.MASK
-				else:
-					# if there is no mask and no payload we are done
-					if self.length <= 0:
-						try:
-							self.handlePacket()
-						finally:
-							self.state = self.HEADERB1
-							self.data = None
+		self.recvlength += read
+		self.parseFrames()
 
-					# we have no mask and some payload
-					else:
-						self.index = 0
-						self.data = bytearray()
-						self.state = self.PAYLOAD
-			
-		elif self.state == self.LENGTHLONG:
 
-			self.lengtharray.append(byte)
+	def parseFrames(self):
+		# handle every complete frame in the receive buffer
+		# headers are read in one go and payloads unmasked all at once, in place
+		buff = self.recvbuffer
+		offset = 0
+		needed = 0
 
-			if len(self.lengtharray) > 8:
-				raise Exception('long length exceeded allowable size')
-
-			if len(self.lengtharray) == 8:
-				self.length = struct.unpack_from('!Q', str(self.lengtharray))[0]
+		try:
+			while True:
+				avail = self.recvlength - offset
+				if avail < 2:
+					break
+
+				b1 = buff[offset]
+				b2 = buff[offset+1]
+				length = b2 & 0x7F
+				headerlen = 2
+
+				if length == 126:
+					headerlen = 4
+					if avail < headerlen:
+						break
+					length = struct.unpack_from('!H', buff, offset+2)[0]
+
+				elif length == 127:
+					headerlen = 10
+					if avail < headerlen:
+						break
+					length = struct.unpack_from('!Q', buff, offset+2)[0]
+
+				hasmask = (b2 & 0x80) == 0x80
+				if hasmask is True:
+					headerlen += 4
 
-				if self.hasmask is True:
-					self.maskarray = bytearray()
-					self.state = self.MASK
-				else:
-					# if there is no mask and no payload we are done
-					if self.length <= 0:
-						try:
-							self.handlePacket()
-						finally:
-							self.state = self.HEADERB1
-							self.data = None
+				# if length exceeds allowable size then we except and remove the connection
+				if length >= self.maxpayload:
+					raise Exception('payload exceeded allowable size')
 
-					# we have no mask and some payload
-					else:
-						self.index = 0
-						self.data = bytearray()
-						self.state = self.PAYLOAD
-			
-		# MASK STATE
-		elif self.state == self.MASK:
-			self.maskarray.append(byte)
+				# wait for the rest of the frame, the buffer must be able to hold it all
+				if avail < headerlen + length:
+					needed = headerlen + length
+					break
 
-			if len(self.maskarray) > 4:
-				raise Exception('mask exceeded allowable size')
+				start = offset + headerlen
+				if hasmask is True:
+					self.maskarray = buff[start-4:start]
+					self.unmask(buff, start, length, self.maskarray)
+				payload = memoryview(buff)[start:start+length]
 
-			if len(self.maskarray) == 4:
-				# if there is no mask and no payload we are done
-				if self.length <= 0:
-					try:
-						self.handlePacket()
-					finally:
-						self.state = self.HEADERB1
-						self.data = None
-						
-				# we have no mask and some payload
-				else:
-					self.index = 0
-					self.data = bytearray()
-					self.state = self.PAYLOAD
-		
-		# PAYLOAD STATE
-		elif self.state == self.PAYLOAD:
-			if self.hasmask is True:
-				self.data.append( byte ^ self.maskarray[self.index % 4] )
-			else:
-				self.data.append( byte )
+				offset = start + length
 
-			# if length exceeds allowable size then we except and remove the connection
-			if len(self.data) >= self.maxpayload:
-				raise Exception('payload exceeded allowable size')
+				self.fin = (b1 & 0x80)
+				self.opcode = (b1 & 0x0F)
+				self.hasmask = hasmask
+				self.length = length
+				self.data = payload
 
-			# check if we have processed length bytes; if so we are done
-			if (self.index+1) == self.length:
 				try:
 					self.handlePacket()
 				finally:
 					self.state = self.HEADERB1
 					self.data = None
-			else:
-				self.index += 1
+					payload = None
+
+				if self.recvbuffer is not buff:
+					# handleMessage kept the payload along with buff, go on in the new receive buffer
+					self.moveReceived(buff, offset, 0)
+					buff = self.recvbuffer
+					offset = 0
+
+		finally:
+			self.moveReceived(buff, offset, needed)
+
+
+	def moveReceived(self, buff, offset, needed):
+		# moves the bytes not parsed yet (from offset in buff) to the start of the receive buffer,
+		# reallocated first if it can't hold the needed bytes of the next frame
+		remaining = self.recvlength - offset
+		target = self.recvbuffer
+		if len(target) < needed:
+			target = bytearray(needed)
+			self.recvbuffer = target
+
+		if remaining > 0 and (target is not buff or offset > 0):
+			target[0:remaining] = buff[offset:self.recvlength]
+		self.recvlength = remaining
+
+
+	def unmask(self, buff, start, length, mask):
+		# xors in place the length bytes from start in buff with the 4 byte mask
+		if numpy is not None:
+			# 4 bytes at a time as uint32, the mask has the same layout as the payload in memory
+			words = length >> 2
+			tail = words << 2
+			if words > 0:
+				mask32 = numpy.frombuffer(mask, numpy.uint32)[0]
+				data = numpy.frombuffer(buff, numpy.uint32, words, start)
+				numpy.bitwise_xor(data, mask32, data)
+				data = None
+			for i in xrange(tail, length):
+				buff[start+i] ^= mask[i & 3]
+		else:
+			for i in xrange(length):
+				buff[start+i] ^= mask[i & 3]
+
+
+# event masks used by the pollers (same values as select.POLLIN, POLLOUT...)
+POLLREAD = 0x001
+POLLWRITE = 0x004
+POLLERROR = 0x008 | 0x010
+
+
+class EpollPoller(object):
+	# linux epoll: O(1) registration and removal, no FD_SETSIZE limit
+
+	def __init__(self):
+		self.epoll = select.epoll()
+
+	def register(self, fd, events):
+		self.epoll.register(fd, events)
+
+	def modify(self, fd, events):
+		self.epoll.modify(fd, events)
+
+	def unregister(self, fd):
+		self.epoll.unregister(fd)
+
+	def poll(self, timeout):
+		return self.epoll.poll(timeout)
+
+	def close(self):
+		self.epoll.close()
+
+
+class PollPoller(object):
+	# poll(2) where epoll does not exist: no FD_SETSIZE limit but O(n) per call
+
+	def __init__(self):
+		self.poller = select.poll()
+
+	def register(self, fd, events):
+		self.poller.register(fd, events)
+
+	def modify(self, fd, events):
+		self.poller.modify(fd, events)
+
+	def unregister(self, fd):
+		self.poller.unregister(fd)
+
+	def poll(self, timeout):
+		return self.poller.poll(timeout * 1000)
+
+	def close(self):
+		pass
+
+
+class SelectPoller(object):
+	# last resort, plain select() with the poller interface
+
+	def __init__(self):
+		self.readers = set()
+		self.writers = set()
+
+	def register(self, fd, events):
+		self.modify(fd, events)
+
+	def modify(self, fd, events):
+		self.unregister(fd)
+		if events & POLLREAD:
+			self.readers.add(fd)
+		if events & POLLWRITE:
+			self.writers.add(fd)
+
+	def unregister(self, fd):
+		self.readers.discard(fd)
+		self.writers.discard(fd)
+
+	def poll(self, timeout):
+		rList, wList, xList = select.select(self.readers, self.writers, self.readers, timeout)
+		events = {}
+		for fd in rList:
+			events[fd] = events.get(fd, 0) | POLLREAD
+		for fd in wList:
+			events[fd] = events.get(fd, 0) | POLLWRITE
+		for fd in xList:
+			events[fd] = events.get(fd, 0) | POLLERROR
+		return events.items()
+
+	def close(self):
+		pass
+
+
+def makePoller():
+	# best event loop backend available on this platform
+	if hasattr(select, 'epoll'):
+		return EpollPoller()
+	if hasattr(select, 'poll'):
+		return PollPoller()
+	return SelectPoller()
+
+
+# SO_REUSEPORT: several processes listen on the same port, the kernel spreads the connections between them
+# Linux 3.9+, python 2 does not always know the constant
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+def listenSocket(host, port, reusePort = False):
+	# non blocking listening socket, as used by SimpleWebSocketServer
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reusePort:
+		if SO_REUSEPORT is None:
+			raise socket.error('SO_REUSEPORT is not supported on this platform')
+		sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+	sock.bind((host, port))
+	sock.listen(socket.SOMAXCONN)
+	sock.setblocking(0)
+	return sock
 
 
 class SimpleWebSocketServer(object):
-	def __init__(self, host, port, websocketclass):
+	def __init__(self, host, port, websocketclass, workers = 0, serversocket = None):
+		# serversocket: already listening socket to accept on (inherited from a parent process...), 
+		# by default the server listens on host:port itself
 		self.websocketclass = websocketclass
-		self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		self.serversocket.bind((host, port))
-		self.serversocket.listen(5)
+		self.serversocket = serversocket
+		if self.serversocket is None:
+			self.serversocket = listenSocket(host, port)
 		self.connections = {}
-		self.listeners = [self.serversocket]
+		# accepted sockets still doing their transport handshake (TLS): fileno -> (socket, address, accept time)
+		self.handshakes = {}
+		self.handshakeTimeout = 10
+		# out of file descriptors (or memory) accept fails until connections close, the listening socket
+		# is not watched for acceptBackoff seconds meanwhile (it would stay readable and spin the loop)
+		self.acceptBackoff = 0.1
+		self.acceptPausedUntil = None
+		# set by stop, serveforever then closes the server and returns
+		self.stopping = False
+		self.poller = makePoller()
+		self.poller.register(self.serversocket.fileno(), POLLREAD | POLLERROR)
+
+		# jobs given to runInWorker run on this pool, None runs them on the event loop
+		self.workers = workers
+		self.pool = None
+		if workers > 0:
+			self.pool = ThreadPool(workers)
+
+		# other threads hand callbacks to the event loop through this queue and wake it up with the pipe
+		self.callbacks = deque()
+		self.wakeread, self.wakewrite = os.pipe()
+		for fd in (self.wakeread, self.wakewrite):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.poller.register(self.wakeread, POLLREAD)
 
 
 	def decorateSocket(self, sock):
 		return sock
 
+	def handshakeSocket(self, sock):
+		# goes on with the transport handshake of a new connection (TLS...) without blocking
+		# returns the poller events to wait for before calling it again, 0 once done
+		return 0
+
+	def pendingData(self, sock):
+		# bytes already read from sock that the poller does not know about (decrypted TLS records...)
+		return 0
+
 	def constructWebSocket(self, sock, address):
 		return self.websocketclass(self, sock, address)
 
 	def close(self):
 		self.serversocket.close()
+
+		for sock, address, started in self.handshakes.itervalues():
+			sock.close()
 	
 		for conn in self.connections.itervalues():
 			try:
 				conn.handleClose()
-			except:
+			except Exception:
 				pass
 	
 			conn.close()
 
+		if self.pool is not None:
+			self.pool.terminate()
 
-	def serveforever(self):
+		self.poller.close()
+		os.close(self.wakeread)
+		os.close(self.wakewrite)
+
+
+	def stop(self):
+		# safe from a signal handler: the loop finishes its turn, then serveforever closes the server and returns
+		self.stopping = True
+		try:
+			os.write(self.wakewrite, 'x')
+		except OSError:
+			pass
+
+
+	def callFromThread(self, callback, *args):
+		# thread safe: callback(*args) will run on the event loop thread
+		self.callbacks.append((callback, args))
+		try:
+			os.write(self.wakewrite, 'x')
+		except OSError as e:
+			# pipe full, the loop is already going to wake up
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise e
+
+
+	def runCallbacks(self):
+		try:
+			while os.read(self.wakeread, 4096):
+				pass
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise e
+
+		while self.callbacks:
+			callback, args = self.callbacks.popleft()
+			try:
+				callback(*args)
+			except Exception as n:
+				logging.debug('callback failed ' + str(n))
+
+
+	def runInWorker(self, func, args, callback):
+		# func(*args) runs on the worker pool, callback(result) then runs on the event loop thread
+		# callback gets None if func raised. Without workers both run right away
+		if self.pool is None:
+			callback(self.runJob(func, args))
+			return
+
+		def done(result):
+			self.callFromThread(callback, result)
+
+		self.pool.apply_async(self.runJob, (func, args), callback=done)
+
+
+	def runJob(self, func, args):
+		try:
+			return func(*args)
+		except Exception as n:
+			logging.debug('worker job failed ' + str(n))
+			return None
+
+
+	def acceptConnections(self):
+		# accept every pending connection, the listening socket is non blocking
 		while True:
-			rList, wList, xList = select(self.listeners, [], self.listeners, 1)	
+			sock = None
+			address = None
+			try:
+				sock, address = self.serversocket.accept()
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				if e.errno in (errno.ECONNABORTED, errno.EPROTO, errno.EINTR):
+					# the client gave up before we accepted it, next one
+					continue
+				logging.debug('accept failed ' + str(e))
+				if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+					self.pauseAccepting()
+				return
+
+			try:
+				sock.setblocking(0)
+				newsock = self.decorateSocket(sock)
+				fileno = newsock.fileno()
+				events = self.handshakeSocket(newsock)
+				if events:
+					# the rest of the handshake is driven by the poller, see continueHandshake
+					self.handshakes[fileno] = (newsock, address, time.time())
+					self.poller.register(fileno, events | POLLERROR)
+				else:
+					self.connections[fileno] = self.constructWebSocket(newsock, address)
+					self.poller.register(fileno, POLLREAD | POLLERROR)
+
+			except Exception as n:
+
+				logging.debug(str(address) + ' ' + str(n))
+
+				if sock is not None:
+					sock.close()
+
+
+	def pauseAccepting(self):
+		self.acceptPausedUntil = time.time() + self.acceptBackoff
+		self.poller.unregister(self.serversocket.fileno())
+
+
+	def resumeAccepting(self):
+		if self.acceptPausedUntil is not None and time.time() >= self.acceptPausedUntil:
+			self.acceptPausedUntil = None
+			self.poller.register(self.serversocket.fileno(), POLLREAD | POLLERROR)
+
+
+	def continueHandshake(self, fileno, event):
+		newsock, address, started = self.handshakes[fileno]
+		try:
+			if event & (POLLREAD | POLLWRITE) == 0:
+				raise Exception('socket error during handshake')
+			events = self.handshakeSocket(newsock)
+			if events:
+				self.poller.modify(fileno, events | POLLERROR)
+				return
+			self.poller.modify(fileno, POLLREAD | POLLERROR)
+			self.connections[fileno] = self.constructWebSocket(newsock, address)
+			del self.handshakes[fileno]
 
-			for ready in rList:
-				if ready == self.serversocket:
+		except Exception as n:
+
+			logging.debug(str(address) + ' ' + str(n))
+
+			self.dropHandshake(fileno)
+
+
+	def dropHandshake(self, fileno):
+		newsock, address, started = self.handshakes.pop(fileno)
+		try:
+			self.poller.unregister(fileno)
+		except Exception:
+			pass
+		newsock.close()
+
+
+	def expireHandshakes(self):
+		# a client that never completes its handshake would hold its socket forever
+		now = time.time()
+		for fileno, (newsock, address, started) in self.handshakes.items():
+			if now - started > self.handshakeTimeout:
+				logging.debug(str(address) + ' handshake timed out')
+				self.dropHandshake(fileno)
+
+
+	def watchWritable(self, client, writable):
+		# the poller tells us when client can take more data only while it has some queued
+		events = POLLREAD | POLLERROR
+		if writable:
+			events |= POLLWRITE
+		self.poller.modify(client.client.fileno(), events)
+
+
+	def dropConnection(self, client):
+		# closes client on the next turn of the loop, whoever is calling
+		self.callFromThread(self.removeClient, client)
+
+
+	def removeClient(self, client):
+		for fileno, conn in self.connections.items():
+			if conn is client:
+				self.removeConnection(fileno)
+				return
+
+
+	def removeConnection(self, fileno):
+		client = self.connections.pop(fileno, None)
+		if client is None:
+			return
+
+		try:
+			self.poller.unregister(fileno)
+		except Exception:
+			pass
+
+		try:
+			client.handleClose()
+		except Exception:
+			pass
+
+		client.close()
+
+
+	def poll(self, timeout):
+		try:
+			return self.poller.poll(timeout)
+		except (select.error, IOError, OSError) as e:
+			# interrupted by a signal, just poll again
+			if e.args and e.args[0] == errno.EINTR:
+				return []
+			raise
+
+
+	def serveforever(self):
+		serverfileno = self.serversocket.fileno()
+
+		while not self.stopping:
+			timeout = 1
+			if self.acceptPausedUntil is not None:
+				timeout = max(0, min(timeout, self.acceptPausedUntil - time.time()))
+
+			for fileno, event in self.poll(timeout):
+				if fileno == serverfileno:
+					if event & POLLERROR:
+						self.close()
+						raise Exception("server socket failed")
+					self.acceptConnections()
+					continue
+
+				if fileno == self.wakeread:
+					self.runCallbacks()
+					continue
+
+				if fileno in self.handshakes:
+					self.continueHandshake(fileno, event)
+					continue
+
+				client = self.connections.get(fileno)
+				if client is None:
+					continue
+
+				if event & POLLWRITE:
 					try:
-						sock, address = self.serversocket.accept()
-						newsock = self.decorateSocket(sock)
-						newsock.setblocking(0)
-						fileno = newsock.fileno()
-						self.listeners.append(fileno)
-						self.connections[fileno] = self.constructWebSocket(newsock, address)
+						client.flushSend()
 
 					except Exception as n:
 
-						logging.debug(str(address) + ' ' + str(n))
+						logging.debug(str(client.address) + ' ' + str(n))
 
-						if sock is not None:
-							sock.close()
-				else:
-					client = self.connections[ready]
-					fileno = client.client.fileno()
-				
+						self.removeConnection(fileno)
+						continue
+
+				if event & POLLREAD:
 					try:
 						client.handleData()
+						while self.pendingData(client.client):
+							client.handleData()
+
+					except ssl.SSLError as e:
+						# only part of a TLS record arrived, the rest will wake us up again
+						if e.errno not in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+
+							logging.debug(str(client.address) + ' ' + str(e))
+
+							self.removeConnection(fileno)
 
 					except Exception as n:
 
 						logging.debug(str(client.address) + ' ' + str(n))
 
-						try:
-							client.handleClose()
-						except:
-							pass
+						self.removeConnection(fileno)
 
-						client.close()
+				elif event & POLLERROR:
+					self.removeConnection(fileno)
 
-						del self.connections[fileno]
-						self.listeners.remove(ready)
-		
-			for failed in xList:
-				if failed == self.serversocket:
-					self.close()
-					raise Exception("server socket failed")
-				else:
-					client = self.connections[failed]
-					fileno = client.client.fileno()
+			if self.handshakes:
+				self.expireHandshakes()
 
-					try:
-						client.handleClose()
-					except:
-						pass
-
-					client.close()
+			self.resumeAccepting()
 
-					del self.connections[fileno]
-					self.listeners.remove(failed)
+		self.close()
 					
 
 class SimpleSSLWebSocketServer(SimpleWebSocketServer):
 
-	def __init__(self, host, port, websocketclass, certfile, keyfile, version = ssl.PROTOCOL_TLSv1):
+	def __init__(self, host, port, websocketclass, certfile, keyfile, version = ssl.PROTOCOL_TLSv1, workers = 0, serversocket = None):
 
-		SimpleWebSocketServer.__init__(self, host, port, websocketclass)
+		SimpleWebSocketServer.__init__(self, host, port, websocketclass, workers, serversocket)
 
 		self.cerfile = certfile
 		self.keyfile = keyfile
 		self.version = version
 
+		# the certificate is loaded once, every connection shares the context
+		self.context = ssl.SSLContext(version)
+		self.context.load_cert_chain(certfile, keyfile)
+
 	def close(self):
 		super(SimpleSSLWebSocketServer, self).close()
 
 	def decorateSocket(self, sock):
-		sslsock = ssl.wrap_socket(sock,
+		# the handshake is not done here (it would block the loop on slow clients) but by handshakeSocket
+		sslsock = self.context.wrap_socket(sock,
 		                     server_side=True,
-		                     certfile=self.cerfile,
-		                     keyfile=self.keyfile,
-		                     ssl_version=self.version)
+		                     do_handshake_on_connect=False)
 		return sslsock
 
+	def handshakeSocket(self, sock):
+		try:
+			sock.do_handshake()
+		except ssl.SSLError as e:
+			if e.errno == ssl.SSL_ERROR_WANT_READ:
+				return POLLREAD
+			if e.errno == ssl.SSL_ERROR_WANT_WRITE:
+				return POLLWRITE
+			raise e
+		return 0
+
+	def pendingData(self, sock):
+		return sock.pending()
+
 	def constructWebSocket(self, sock, address):
 		ws = self.websocketclass(self, sock, address)
 		ws.usingssl = True
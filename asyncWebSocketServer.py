@@ -0,0 +1,341 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## asyncWebSocketServer.py
+## AsyncWebSocketServer serves the same WebSocket subclasses as SimpleWebSocketServer (handleConnected,
+## handleMessage, handleClose, sendMessage...), on an asyncio event loop instead of our own poll loop:
+## asyncio reads and buffers the sockets, TransportSocket hands their data to WebSocket.handleData as
+## if it came from recv, and what WebSocket sends goes to the transport, that writes it when it can.
+## VideoServer runs on it unchanged.
+##
+## runInWorker runs the detection on a ThreadPoolExecutor (workers threads) through run_in_executor,
+## the event loop keeps reading and writing the other connections meanwhile (OpenCV releases the GIL).
+## Connections that don't complete their handshake in handshakeTimeout seconds, or send nothing
+## for idleTimeout seconds, are closed. With TLS the transport only calls connection_made once the TLS
+## handshake is done, TLSHandshakes times that first handshake. Closing the server closes every
+## connection and cancels the jobs that have not started yet.
+##
+## Like SimpleWebSocketServer this is Python 2, on trollius, the asyncio backport: pip install trollius
+## (and pip install futures for the workers). Only the callback API of asyncio is used (no coroutine syntax).
+##
+## Typical use:
+##   server = AsyncWebSocketServer(host, port, VideoServer, workers=2)
+##   server.serveforever()
+
+####################################################################################################
+import ssl
+import time
+import errno
+import socket
+import logging
+from SimpleWebSocketServer import listenSocket
+
+try:
+    import trollius as asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+####################################################################################################
+
+
+####################################################################################################
+## What WebSocket uses of its socket (recv, recv_into, send, close), on top of an asyncio transport
+
+class TransportSocket(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.received = b''     ## data of data_received not read by the WebSocket yet
+        self.paused = False     ## the transport buffers too much already, see pause_writing
+        self.closed = False
+
+    def feed(self, data):
+        self.received += data
+
+    def pending(self):
+        return len(self.received)
+
+    def recv(self, size):
+        ## Up to size bytes received already, '' once closed (the WebSocket then sees the remote socket closed)
+        data = self.received[:size]
+        self.received = self.received[size:]
+        return data
+
+    def recv_into(self, buff):
+        ## Copies up to len(buff) bytes received already into buff, returns their number
+        size = min(len(buff), len(self.received))
+        buff[0:size] = self.received[:size]
+        self.received = self.received[size:]
+        return size
+
+    def send(self, buff):
+        ## The transport takes everything, unless it asked us to stop: the WebSocket then keeps its queue
+        ## as with a full socket buffer, resume_writing flushes it
+        if self.closed:
+            raise socket.error(errno.EPIPE, 'connection closed')
+        if self.paused:
+            raise socket.error(errno.EAGAIN, 'transport paused')
+        self.transport.write(buff)
+        return len(buff)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transport.close()
+
+    def abort(self):
+        ## Closes without sending what the transport still has buffered (close would wait for the client to read it)
+        self.closed = True
+        self.transport.abort()
+
+    def fileno(self):
+        return -1
+
+
+####################################################################################################
+## TLS handshakes in progress
+
+class TLSHandshakes(object):
+    ## Stands in for the SSLContext given to create_server: the SSL transport wraps each accepted socket
+    ## with it and does the handshake before anything reaches the protocol, the sockets wrapped here are
+    ## the ones in their handshake until connection_made. Everything else goes to the real context
+    ## A socket past the timeout is shut down, the transport sees the handshake fail and closes it
+
+    def __init__(self, context):
+        self.context = context
+        self.sockets = {}  ## SSL socket -> (accepted socket, time of the accept)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        sslsock = self.context.wrap_socket(sock, *args, **kwargs)
+        self.sockets[sslsock] = (sock, time.time())
+        return sslsock
+
+    def done(self, sslsock):
+        self.sockets.pop(sslsock, None)
+
+    def expire(self, now, timeout):
+        ## Also forgets the sockets whose handshake failed, they are closed already
+        for sslsock, (sock, started) in self.sockets.items():
+            if now - started > timeout:
+                del self.sockets[sslsock]
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+####################################################################################################
+## One connection: the asyncio protocol feeding a WebSocket
+
+class WebSocketProtocol(asyncio.Protocol if asyncio is not None else object):
+
+    def __init__(self, server):
+        self.server = server
+        self.socket = None
+        self.client = None
+        self.connected = 0
+        self.lastData = 0
+
+    def connection_made(self, transport):
+        if self.server.tlsHandshakes is not None:
+            self.server.tlsHandshakes.done(transport.get_extra_info('socket'))
+        self.socket = TransportSocket(transport)
+        self.client = self.server.constructWebSocket(self.socket, transport.get_extra_info('peername'))
+        self.connected = self.lastData = time.time()
+        self.server.connections.add(self)
+
+    def data_received(self, data):
+        self.lastData = time.time()
+        self.socket.feed(data)
+        try:
+            ## handleData reads at most a header or what its receive buffer holds at a time
+            while self.socket.pending() and not self.socket.closed:
+                self.client.handleData()
+        except Exception as n:
+            logging.debug(str(self.client.address) + ' ' + str(n))
+            self.socket.close()
+
+    def eof_received(self):
+        ## Closes the transport
+        return False
+
+    def connection_lost(self, exc):
+        if self not in self.server.connections:
+            return
+        self.server.connections.discard(self)
+        self.socket.closed = True
+        try:
+            self.client.handleClose()
+        except:
+            pass
+
+    def pause_writing(self):
+        self.socket.paused = True
+
+    def resume_writing(self):
+        self.socket.paused = False
+        try:
+            self.client.flushSend()
+        except Exception as n:
+            logging.debug(str(self.client.address) + ' ' + str(n))
+            self.socket.close()
+
+    def expired(self, now):
+        if not self.client.handshaked:
+            return now - self.connected > self.server.handshakeTimeout
+        return self.server.idleTimeout is not None and now - self.lastData > self.server.idleTimeout
+
+
+####################################################################################################
+class AsyncWebSocketServer(object):
+
+    def __init__(self, host, port, websocketclass, workers=0, serversocket=None, sslContext=None,
+                 handshakeTimeout=10, idleTimeout=None, loop=None):
+        ## workers: detection threads of runInWorker, 0 runs the jobs on the event loop (as SimpleWebSocketServer)
+        ## serversocket: already listening socket to accept on (--processes), by default the server listens on host:port
+        ## sslContext: ssl.SSLContext with the certificate loaded, the handshakes are then done by asyncio without blocking
+        ## handshakeTimeout, idleTimeout: seconds (None: never) after which the connection is closed
+        if asyncio is None:
+            raise ImportError('AsyncWebSocketServer needs trollius (pip install trollius)')
+        if workers > 0 and ThreadPoolExecutor is None:
+            raise ImportError('AsyncWebSocketServer workers need concurrent.futures (pip install futures)')
+
+        self.websocketclass = websocketclass
+        self.serversocket = serversocket
+        if self.serversocket is None:
+            self.serversocket = listenSocket(host, port)
+        self.sslContext = sslContext
+        self.tlsHandshakes = None
+        self.handshakeTimeout = handshakeTimeout
+        self.idleTimeout = idleTimeout
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.connections = set()
+        self.server = None
+
+        self.workers = workers
+        self.executor = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(workers)
+        self.jobs = set()
+
+    def constructWebSocket(self, sock, address):
+        ws = self.websocketclass(self, sock, address)
+        ws.usingssl = self.sslContext is not None
+        return ws
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.serversocket.close()
+
+        for conn in list(self.connections):
+            self.connections.discard(conn)
+            try:
+                conn.client.handleClose()
+            except Exception:
+                pass
+            conn.socket.close()
+
+        for job in list(self.jobs):
+            job.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+        self.loop.stop()
+
+    def stop(self):
+        ## Safe from a signal handler: the loop closes the server on its next turn, serveforever then returns
+        self.loop.call_soon_threadsafe(self.close)
+
+    def callFromThread(self, callback, *args):
+        ## thread safe: callback(*args) will run on the event loop thread
+        self.loop.call_soon_threadsafe(self.runCallback, callback, args)
+
+    def runCallback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as n:
+            logging.debug('callback failed ' + str(n))
+
+    def runInWorker(self, func, args, callback):
+        ## func(*args) runs on the executor, callback(result) then runs on the event loop thread
+        ## callback gets None if func raised, it is not called for the jobs cancelled by close
+        if self.executor is None:
+            callback(self.runJob(func, args))
+            return
+
+        job = self.loop.run_in_executor(self.executor, self.runJob, func, args)
+        self.jobs.add(job)
+
+        def done(job):
+            self.jobs.discard(job)
+            if not job.cancelled():
+                self.runCallback(callback, (job.result(),))
+
+        job.add_done_callback(done)
+
+    def runJob(self, func, args):
+        try:
+            return func(*args)
+        except Exception as n:
+            logging.debug('worker job failed ' + str(n))
+            return None
+
+    def dropConnection(self, client):
+        ## Closes client on the next turn of the loop (its send queue overflowed...), connection_lost follows
+        self.loop.call_soon_threadsafe(client.client.abort)
+
+    def watchWritable(self, client, writable):
+        ## The transport writes by itself, TransportSocket.send only fails while it is paused
+        ## and resume_writing flushes the WebSocket then
+        pass
+
+    def checkTimeouts(self):
+        now = time.time()
+        if self.tlsHandshakes is not None:
+            self.tlsHandshakes.expire(now, self.handshakeTimeout)
+        for conn in list(self.connections):
+            if conn.expired(now):
+                logging.debug(str(conn.client.address) + ' timed out')
+                conn.socket.close()
+        self.loop.call_later(1, self.checkTimeouts)
+
+    def serveforever(self):
+        sslContext = self.sslContext
+        if sslContext is not None and self.handshakeTimeout is not None:
+            sslContext = self.tlsHandshakes = TLSHandshakes(sslContext)
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: WebSocketProtocol(self), sock=self.serversocket, ssl=sslContext))
+        self.loop.call_later(1, self.checkTimeouts)
+        self.loop.run_forever()
@@ -0,0 +1,258 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## benchmark.py
+## Offline benchmark of eyeDetector: decodeImage, detectEyes and encodeImage over a corpus of frames
+## Inputs: a corpus of frames, one of:
+##         --frames DIR      every jpeg/png in the directory, in name order
+##         --video FILE      frames of a video file, encoded to jpeg
+##         --synthetic N     N generated frames (seeded, always the same frames for the same options)
+## Outputs: per stage throughput and p50/p95/p99 latency for every combination of
+##          --scales, --faceScaleFactors, --faceMinNeighbors and --eyesScaleFactors
+##          --output FILE writes the results as json, --compare FILE shows the difference with a previous run
+##
+## Run from the directory holding haarCascadesXML, e.g.
+## python benchmark.py --video session.webm --scales 0.5,0.7 --eyesScaleFactors 1.01,1.05 --output today.json
+####################################################################################################
+
+####################################################################################################
+import os, sys, time, json, platform, itertools
+from optparse import OptionParser
+import cv2
+import numpy as np
+
+import eyeDetector
+####################################################################################################
+
+
+####################################################################################################
+## Corpus: a list of byte-encoded frames, as the clients would send them
+
+def loadFrames(directory):
+    ## Every jpeg and png of directory, raw bytes, in name order
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                frames.append(np.fromstring(f.read(), dtype=np.uint8))
+    return frames
+
+def loadVideo(path, maxFrames, quality):
+    ## Frames of a video file, encoded to jpeg with the given quality
+    frames = []
+    capture = cv2.VideoCapture(path)
+    while len(frames) < maxFrames:
+        ok, img = capture.read()
+        if not ok:
+            break
+        frames.append(cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])[1])
+    capture.release()
+    return frames
+
+def syntheticFrames(count, width, height, quality, seed=0):
+    ## Noisy frames with a crude face (skin ellipse, two dark eyes) moving around
+    ## Haar cascades may or may not see a face in them: they measure speed, not accuracy
+    random = np.random.RandomState(seed)
+    frames = []
+    for i in range(count):
+        img = random.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        img = cv2.GaussianBlur(img, (0,0), 3)
+        cx = int(width/2 + width/8*np.sin(i/10.0))
+        cy = int(height/2 + height/16*np.cos(i/10.0))
+        r = height/5
+        cv2.ellipse(img, (cx, cy), (int(r*0.8), r), 0, 0, 360, (150, 180, 220), -1)
+        for dx in (-r/3, r/3):
+            cv2.ellipse(img, (cx+dx, cy-r/4), (r/6, r/10), 0, 0, 360, (40, 40, 40), -1)
+        cv2.ellipse(img, (cx, cy+r/2), (r/3, r/10), 0, 0, 360, (60, 60, 140), -1)
+        frames.append(cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])[1])
+    return frames
+
+
+####################################################################################################
+## Statistics
+
+def percentile(values, p):
+    ## p-th percentile (0-100) of a sorted list, nearest rank
+    if not values:
+        return None
+    rank = int(np.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def summarize(samples):
+    ## samples: seconds per call. Returns calls per second and latencies in milliseconds
+    values = sorted(samples)
+    total = sum(values)
+    summary = {'count': len(values), 'throughput': len(values) / total if total > 0 else None}
+    for p in (50, 95, 99):
+        summary['p%d' % p] = 1000.0 * percentile(values, p)
+    summary['mean'] = 1000.0 * total / len(values)
+    return summary
+
+class SampleStats(object):
+    ## Keeps every sample (eyeDetector stats interface), exact percentiles instead of histogram buckets
+    def __init__(self):
+        self.samples = {}
+        self.counters = {}
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+####################################################################################################
+def runSetting(frames, baseProfile, setting, repeat, track, gate=False):
+    ## Runs the whole corpus repeat times with baseProfile, the detection parameters in setting changed
+    ## Returns the per stage summaries and the detection counters of the last run
+    profile = baseProfile.copy(**setting)
+    for run in range(repeat):
+        stats = SampleStats()
+        tracker = eyeDetector.EyeTracker(stats=stats, profile=profile, trackEyes=(track == 'eyes'), motionGate=gate)
+        for frame in frames:
+            start = time.time()
+            img = eyeDetector.decodeImage(frame)
+            stats.record('decodeImage', time.time() - start)
+            if img is None:
+                continue
+
+            start = time.time()
+            if track:
+                tracker.detectEyes(img)
+            else:
+                eyeDetector.detectEyes(img, stats, profile)
+            stats.record('detectEyes', time.time() - start)
+
+            start = time.time()
+            eyeDetector.encodeImage(img, profile)
+            stats.record('encodeImage', time.time() - start)
+
+            start = time.time()
+            eyeDetector.detectEyesFast(frame, profile=profile)
+            stats.record('detectEyesFast', time.time() - start)
+
+    ## The first runs only warm up caches, stats holds the last one
+    stages = dict((stage, summarize(samples)) for (stage, samples) in stats.samples.items())
+    return {'parameters': setting, 'stages': stages, 'counters': stats.counters}
+
+
+####################################################################################################
+def printResult(result, previous=None):
+    ## One line per stage, with the change in p50 against the same setting of a previous run
+    print ', '.join('%s=%s' % item for item in sorted(result['parameters'].items())), \
+          ' | faces %(faces)d/%(frames)d, eyes %(eyes)d/%(frames)d' % dict({'faces': 0, 'eyes': 0, 'frames': 0}, **result['counters'])
+    for (stage, s) in sorted(result['stages'].items()):
+        line = '    %-16s %8.1f/s  p50 %8.2f  p95 %8.2f  p99 %8.2f ms' % (stage, s['throughput'] or 0, s['p50'], s['p95'], s['p99'])
+        if previous is not None and stage in previous['stages']:
+            before = previous['stages'][stage]['p50']
+            if before > 0:
+                line += '  (p50 %+.1f%%)' % (100.0 * (s['p50'] - before) / before)
+        print line
+
+def findPrevious(previousResults, setting):
+    for result in previousResults:
+        if result['parameters'] == setting:
+            return result
+    return None
+
+def floats(text):
+    return [float(value) for value in text.split(',')]
+
+def ints(text):
+    return [int(value) for value in text.split(',')]
+
+
+##################################################################################################
+if __name__ == "__main__":
+
+    parser = OptionParser(usage="usage: %prog [options]", version="%prog 1.0")
+    parser.add_option("--frames", default=None, type='string', action="store", dest="frames", help="directory of jpeg/png frames")
+    parser.add_option("--video", default=None, type='string', action="store", dest="video", help="video file")
+    parser.add_option("--synthetic", default=0, type='int', action="store", dest="synthetic", help="number of synthetic frames (default if nothing else is given: 100)")
+    parser.add_option("--size", default='320x240', type='string', action="store", dest="size", help="synthetic frame size (320x240)")
+    parser.add_option("--seed", default=0, type='int', action="store", dest="seed", help="synthetic frames random seed (0)")
+    parser.add_option("--maxFrames", default=300, type='int', action="store", dest="maxFrames", help="maximum frames read from the video (300)")
+    parser.add_option("--quality", default=20, type='int', action="store", dest="quality", help="jpeg quality of video and synthetic frames (20)")
+    parser.add_option("--profile", default='default', type='choice', choices=sorted(eyeDetector.profiles), action="store", dest="profile", help="detector profile the settings below start from: " + ', '.join(sorted(eyeDetector.profiles)) + ' (default)')
+    parser.add_option("--scales", default=None, type='string', action="store", dest="scales", help="comma separated scales to try (those of the profile)")
+    parser.add_option("--faceScaleFactors", default=None, type='string', action="store", dest="faceScaleFactors", help="comma separated face scaleFactors (those of the profile)")
+    parser.add_option("--faceMinNeighbors", default=None, type='string', action="store", dest="faceMinNeighbors", help="comma separated face minNeighbors (those of the profile)")
+    parser.add_option("--eyesScaleFactors", default=None, type='string', action="store", dest="eyesScaleFactors", help="comma separated eyes scaleFactors (those of the profile)")
+    parser.add_option("--gate", default=False, action="store_true", dest="gate", help="with --track or --trackEyes, reuse the previous result for static frames")
+    parser.add_option("--repeat", default=2, type='int', action="store", dest="repeat", help="runs over the corpus per setting, only the last one is measured (2)")
+    parser.add_option("--track", default=False, action="store_const", const='face', dest="track", help="use an EyeTracker, frames are consecutive frames of a stream")
+    parser.add_option("--trackEyes", default=False, action="store_const", const='eyes', dest="track", help="same as --track, the EyeTracker also follows the eyes by template matching")
+    parser.add_option("--output", default=None, type='string', action="store", dest="output", help="write the results to this json file")
+    parser.add_option("--compare", default=None, type='string', action="store", dest="compare", help="json file of a previous run to compare with")
+    (options, args) = parser.parse_args()
+
+    if options.frames:
+        corpus = 'frames:' + options.frames
+        frames = loadFrames(options.frames)
+    elif options.video:
+        corpus = 'video:' + options.video
+        frames = loadVideo(options.video, options.maxFrames, options.quality)
+    else:
+        count = options.synthetic or 100
+        (width, height) = [int(value) for value in options.size.split('x')]
+        corpus = 'synthetic:%d:%s:seed%d:q%d' % (count, options.size, options.seed, options.quality)
+        frames = syntheticFrames(count, width, height, options.quality, options.seed)
+
+    if not frames:
+        print 'ERROR: No frames in corpus ' + corpus
+        sys.exit(1)
+
+    previousResults = []
+    if options.compare:
+        with open(options.compare) as f:
+            previousResults = json.load(f)['results']
+
+    print 'Corpus ' + corpus + ', ' + str(len(frames)) + ' frames, OpenCV ' + cv2.__version__
+    print '*****************************************************************'
+
+    ## Parameters not given on the command line keep the value of the profile
+    baseProfile = eyeDetector.profiles[options.profile]
+    scales = floats(options.scales or str(baseProfile.scale))
+    faceScaleFactors = floats(options.faceScaleFactors or str(baseProfile.faceScaleFactor))
+    faceMinNeighbors = ints(options.faceMinNeighbors or str(baseProfile.faceMinNeighbors))
+    eyesScaleFactors = floats(options.eyesScaleFactors or str(baseProfile.eyesScaleFactor))
+
+    results = []
+    grid = itertools.product(scales, faceScaleFactors, faceMinNeighbors, eyesScaleFactors)
+    for (scale, faceScaleFactor, faceMinNeighbors, eyesScaleFactor) in grid:
+        setting = {'scale': scale, 'faceScaleFactor': faceScaleFactor, 'faceMinNeighbors': faceMinNeighbors, 'eyesScaleFactor': eyesScaleFactor}
+        result = runSetting(frames, baseProfile, setting, max(1, options.repeat), options.track, options.gate)
+        printResult(result, findPrevious(previousResults, setting))
+        results.append(result)
+
+    if options.output:
+        report = {'corpus': corpus, 'frames': len(frames), 'track': options.track, 'gate': options.gate, 'profile': options.profile,
+                  'opencv': cv2.__version__, 'python': platform.python_version(), 'machine': platform.platform(),
+                  'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print 'Results written to ' + options.output
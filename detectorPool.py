@@ -0,0 +1,411 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## detectorPool.py
+## The detection threads of --workers share one process, the Python side of every frame still runs on one core.
+## DetectorPool runs the detection in separate processes, behind the event loop of the server, without
+## pickling frames and images through pipes: the frames and the replies go through a ring of slots in shared
+## memory (an anonymous mmap created before forking the detector processes), only slot indices go through the pipes.
+##
+## The event loop takes a free slot, writes the frame received in it and sends the slot index to a detector
+## process. The detector decodes the frame in place, detects the eyes and writes the coordinates and the
+## encoded reply image (if any) back into the slot, then sends the index back. A thread of the server process
+## waits for these indices and hands them to the event loop (server.callFromThread), where the reply is read
+## from the slot and sent, and the slot freed.
+##
+## Every connection always goes to the same detector process, which keeps its EyeTracker: the tracker follows
+## the frames of the connection one after the other. Frames larger than a slot, or arriving while every slot
+## is taken, are refused (submit returns False).
+##
+## The detector processes exit when their request pipe is closed (close, or the server process is gone).
+## Each one holds the write end of a life pipe, which closes when it dies: the thread collecting the results
+## then completes the frames it was detecting with the status DETECTOR_GONE. It is not restarted (forking from
+## the threaded server process is not safe), its connections go to the next detector from then on.
+##
+## Typical use:
+##   pool = DetectorPool(4)    ## before the server starts its threads: no forking a process with threads
+##   server = SimpleWebSocketServer(host, port, VideoServer)
+##   pool.attach(server)
+
+####################################################################################################
+import os
+import time
+import mmap
+import errno
+import select
+import struct
+import signal
+import base64
+import logging
+import threading
+import numpy as np
+
+import eyeDetector
+import preforkServer
+####################################################################################################
+
+
+####################################################################################################
+## Layout of a slot: request header, result header, frame, reply image
+
+## Request of the event loop: connection, operation, flags, profile name, frame length, boxes to draw (DRAW_ONLY)
+requestHeader = struct.Struct('=IBB16sI12h')
+## Result of the detector: status, eyesX, eyesY, reply length, face and eye boxes,
+## seconds spent decoding, detecting, drawing and encoding
+resultHeader = struct.Struct('=BhhI12hfff')
+
+## Operations, one per reply mode of VideoServer
+COORDS = 0   ## coordinates only, the frame is decoded straight to greyscale
+JPEG = 1     ## coordinates and the frame with the boxes drawn, as jpeg
+BASE64 = 2   ## same as JPEG, base64 encoded
+
+## Flags
+TRACK_EYES = 1   ## EyeTracker trackEyes
+MOTION_GATE = 2  ## EyeTracker motionGate
+DRAW_ONLY = 4    ## no detection, only draw the boxes of the request (coordinates predicted by the server)
+
+## Status
+OK = 0
+DECODE_FAILED = 1
+ENCODE_FAILED = 2
+REPLY_TOO_LARGE = 3
+DETECTOR_GONE = 4  ## the detector process died with the frame
+
+## Slot indices through the pipes, negative ones are messages about a connection (see disconnect)
+slotIndex = struct.Struct('=i')
+
+def packBoxes(faceBox, eyeBoxes):
+    ## 12 ints: the face then both eyes, -1 for the missing ones (as in the binary replies of VideoServer)
+    return (faceBox or [-1]*4) + (sum(eyeBoxes, []) + [-1]*8)[:8]
+
+def unpackBoxes(boxes):
+    faceBox = list(boxes[0:4]) if boxes[2] >= 0 else None
+    eyeBoxes = [list(boxes[i:i+4]) for i in (4, 8) if boxes[i+2] >= 0]
+    return faceBox, eyeBoxes
+
+
+####################################################################################################
+class DetectorPool(object):
+
+    def __init__(self, processes, slots=64, slotSize=1024*1024):
+        ## processes: number of detector processes, forked right away
+        ## slots: frames being detected at most, all processes together (one per connection at a time)
+        ## slotSize: bytes of a slot, half of what is left after the headers for the frame, half for the reply
+        self.processes = processes
+        self.slots = slots
+        self.slotSize = slotSize
+        self.frameStart = requestHeader.size + resultHeader.size
+        self.frameSize = (slotSize - self.frameStart) // 2
+        self.replyStart = self.frameStart + self.frameSize
+        self.replySize = slotSize - self.replyStart
+
+        ## Shared with the detector processes, mmap(-1) is MAP_SHARED | MAP_ANONYMOUS
+        self.memory = mmap.mmap(-1, slots*slotSize)
+        self.view = np.frombuffer(self.memory, np.uint8)
+
+        ## Only the event loop thread takes and frees slots
+        self.free = list(range(slots))
+        self.callbacks = {}   ## slot index -> callback of the frame in it
+        self.owners = {}      ## slot index -> number of the detector process detecting it
+        self.dead = set()     ## numbers of the detector processes gone
+        self.nextConnection = 0
+        self.server = None
+        self.closed = False
+
+        ## One pipe per detector for the requests, one shared by all of them for the results
+        ## (indices are 4 bytes, pipe writes that small are atomic)
+        ## and one per detector that nothing is written to, its read end only sees the end of the detector
+        self.resultRead, self.resultWrite = os.pipe()
+        self.requestPipes = []
+        self.lifePipes = {}   ## read end -> number of the detector process
+        self.children = []
+        for number in range(processes):
+            read, write = os.pipe()
+            lifeRead, lifeWrite = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(write)
+                os.close(lifeRead)
+                self.runDetector(number, read)
+            os.close(read)
+            os.close(lifeWrite)
+            self.requestPipes.append(write)
+            self.lifePipes[lifeRead] = number
+            self.children.append(pid)
+        os.close(self.resultWrite)
+        logging.info('detectors: %d processes, %d slots of %d KB', processes, slots, slotSize // 1024)
+
+    ##############################################################################################
+    ## Event loop side
+
+    def attach(self, server):
+        ## The slots done are handed to the event loop of server (callFromThread)
+        self.server = server
+        thread = threading.Thread(target=self.collect, name='detectorPool')
+        thread.daemon = True
+        thread.start()
+
+    def connect(self):
+        ## Number of a new connection, to submit its frames with
+        connection = self.nextConnection
+        self.nextConnection += 1
+        return connection
+
+    def disconnect(self, connection):
+        ## The connection is closed, its detector forgets its EyeTracker
+        number = self.detectorOf(connection)
+        if number is not None:
+            self.sendIndex(number, -connection - 1)
+
+    def submit(self, connection, frame, operation, flags, profile, faceBox=None, eyeBoxes=[], callback=None):
+        ## Copies frame (bytearray, memoryview...) into a free slot and sends it to the detector of connection
+        ## callback(slot) runs on the event loop thread once done, read the slot with result(slot) there:
+        ## the slot is reused as soon as the callback returns
+        ## Returns False if the frame was refused (larger than a slot, no free slot, every detector gone)
+        number = self.detectorOf(connection)
+        if len(frame) > self.frameSize or not self.free or number is None:
+            return False
+
+        ## Whatever can raise is done before taking the slot, it would be lost otherwise
+        header = requestHeader.pack(connection, operation, flags, profile.name, len(frame), *packBoxes(faceBox, eyeBoxes))
+        frame = np.asarray(frame)
+
+        slot = self.free.pop()
+        offset = slot*self.slotSize
+        self.memory[offset:offset+requestHeader.size] = header
+        start = offset + self.frameStart
+        self.view[start:start+len(frame)] = frame
+
+        self.callbacks[slot] = callback
+        self.owners[slot] = number
+        if not self.sendIndex(number, slot):
+            del self.callbacks[slot]
+            del self.owners[slot]
+            self.free.append(slot)
+            return False
+        return True
+
+    def result(self, slot):
+        ## Returns status, eyesX, eyesY, faceBox, eyeBoxes, reply, seconds of a slot done
+        ## reply: view of the encoded image in the slot (None if there is none), only valid until the slot is reused
+        ## seconds: time spent decoding, detecting, drawing and encoding
+        offset = slot*self.slotSize
+        values = resultHeader.unpack_from(self.memory, offset + requestHeader.size)
+        (status, eyesX, eyesY, length) = values[0:4]
+        faceBox, eyeBoxes = unpackBoxes(values[4:16])
+        reply = None
+        if length > 0:
+            start = offset + self.replyStart
+            reply = self.view[start:start+length]
+        return status, eyesX, eyesY, faceBox, eyeBoxes, reply, values[16:19]
+
+    def detectorOf(self, connection):
+        ## Number of the detector process of connection, None once they are all gone
+        ## The connections of a detector gone go to the next one, their trackers start over there
+        for number in range(connection, connection + self.processes):
+            if number % self.processes not in self.dead:
+                return number % self.processes
+        return None
+
+    def sendIndex(self, number, value):
+        try:
+            os.write(self.requestPipes[number], slotIndex.pack(value))
+        except OSError as e:
+            ## Its life pipe tells collect as well, detectorGone completes the frames it had
+            logging.warning('detectors: process %d gone (%s)', number, e)
+            return False
+        return True
+
+    def collect(self):
+        ## Thread of the server process: slots done and detectors gone, back to the event loop
+        watched = dict(self.lifePipes)
+        while watched:
+            try:
+                ready = select.select([self.resultRead] + list(watched), [], [])[0]
+                if self.closed:
+                    return
+                gone = [fd for fd in ready if fd != self.resultRead]
+                ## What a detector wrote before dying is in the result pipe by the time its life pipe closes,
+                ## its last results go to the event loop before its death
+                while self.resultRead in ready:
+                    data = os.read(self.resultRead, 4096)
+                    if not data:
+                        gone = list(watched)
+                        break
+                    for slot in np.frombuffer(data, np.int32):
+                        self.server.callFromThread(self.done, int(slot))
+                    ready = select.select([self.resultRead], [], [], 0)[0] if gone else []
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise e
+
+            for fd in gone:
+                os.close(fd)
+                self.server.callFromThread(self.detectorGone, watched.pop(fd))
+        logging.warning('detectors: every detector process is gone')
+
+    def detectorGone(self, number):
+        ## The detector process number died, the frames it was detecting are done with DETECTOR_GONE
+        self.dead.add(number)
+        pid = self.children[number]
+        try:
+            pid, status = os.waitpid(pid, 0)
+            logging.warning('detectors: process %d (pid %d) %s', number, pid, preforkServer.describeStatus(status))
+        except OSError:
+            pass
+        for slot in [slot for slot, owner in self.owners.items() if owner == number]:
+            self.failSlot(slot, DETECTOR_GONE)
+            self.done(slot)
+
+    def done(self, slot):
+        self.owners.pop(slot, None)
+        callback = self.callbacks.pop(slot, None)
+        try:
+            if callback is not None:
+                callback(slot)
+        finally:
+            self.free.append(slot)
+
+    def close(self):
+        ## Stops the detector processes, the frames being detected are lost
+        self.closed = True
+        for fd in self.requestPipes:
+            os.close(fd)
+        self.requestPipes = []
+        for number, pid in enumerate(self.children):
+            if number in self.dead:
+                continue
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.children = []
+
+    ##############################################################################################
+    ## Detector side
+
+    def runDetector(self, number, requestRead):
+        ## In the forked process, never returns
+        status = 0
+        try:
+            ## Ctrl-C reaches the whole process group, the server process stops us by closing the pipe
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            ## The pipes of the other detectors must close when the server process does
+            for fd in self.requestPipes + [self.resultRead] + list(self.lifePipes):
+                os.close(fd)
+
+            trackers = {}
+            while True:
+                data = os.read(requestRead, 4096)
+                if not data:
+                    break
+                for slot in np.frombuffer(data, np.int32):
+                    if slot < 0:
+                        trackers.pop(-slot - 1, None)
+                        continue
+                    try:
+                        self.detect(trackers, int(slot))
+                    except Exception as n:
+                        logging.warning('detectors: process %d failed on a frame: %s', number, n)
+                        self.failSlot(int(slot), DECODE_FAILED)
+                    os.write(self.resultWrite, slotIndex.pack(int(slot)))
+        except Exception:
+            logging.exception('detectors: process %d failed', number)
+            status = 1
+        os._exit(status)
+
+    def failSlot(self, slot, status):
+        ## Result of a frame that could not be detected: status, no eyes, no reply
+        resultHeader.pack_into(self.memory, slot*self.slotSize + requestHeader.size,
+                               status, -1, -1, 0, *([-1]*12 + [0, 0, 0]))
+
+    def detect(self, trackers, slot):
+        ## Detects the eyes of the frame of slot and writes the result back into it
+        offset = slot*self.slotSize
+        values = requestHeader.unpack_from(self.memory, offset)
+        (connection, operation, flags, profileName, length) = values[0:5]
+        profile = eyeDetector.profiles.get(profileName.rstrip('\0'), eyeDetector.defaultProfile)
+        start = offset + self.frameStart
+        frame = self.view[start:start+length]
+
+        status = OK
+        eyesX, eyesY, faceBox, eyeBoxes = -1, -1, None, []
+        encImg = None
+        seconds = [0.0, 0.0, 0.0]
+
+        if flags & DRAW_ONLY:
+            faceBox, eyeBoxes = unpackBoxes(values[5:17])
+        else:
+            tracker = trackers.get(connection)
+            if tracker is None:
+                tracker = eyeDetector.EyeTracker(profile=profile, trackEyes=bool(flags & TRACK_EYES), motionGate=bool(flags & MOTION_GATE))
+                trackers[connection] = tracker
+            elif tracker.profile is not profile:
+                tracker.setProfile(profile)
+
+        begin = time.time()
+        if operation == COORDS:
+            img = eyeDetector.decodeImageGray(frame, profile)
+        else:
+            img = eyeDetector.decodeImage(frame)
+        seconds[0] = time.time() - begin
+
+        if img is None:
+            status = DECODE_FAILED
+        else:
+            if not flags & DRAW_ONLY:
+                begin = time.time()
+                gray = img if operation == COORDS else eyeDetector.prepareImage(img, profile)
+                face, eyes = tracker.locateEyes(gray)
+                eyesX, eyesY = eyeDetector.eyesCenter(face, eyes, profile)
+                faceBox, eyeBoxes = eyeDetector.imageBoxes(face, eyes, profile)
+                seconds[1] = time.time() - begin
+
+            if operation != COORDS:
+                begin = time.time()
+                eyeDetector.drawBoxes(img, faceBox, eyeBoxes)
+                retval, encImg = eyeDetector.encodeImage(img, profile)
+                if not retval:
+                    status, encImg = ENCODE_FAILED, None
+                elif operation == BASE64:
+                    encImg = np.frombuffer(base64.b64encode(encImg), np.uint8)
+                seconds[2] = time.time() - begin
+
+        length = 0
+        if encImg is not None:
+            encImg = encImg.ravel()
+            if len(encImg) > self.replySize:
+                status = REPLY_TOO_LARGE
+            else:
+                length = len(encImg)
+                start = offset + self.replyStart
+                self.view[start:start+length] = encImg
+
+        resultHeader.pack_into(self.memory, offset + requestHeader.size, status, eyesX, eyesY, length,
+                               *(packBoxes(faceBox, eyeBoxes) + seconds))
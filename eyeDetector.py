@@ -29,7 +29,13 @@
 ## Implements 3 related functions:
 ## decodeImage(rawImage) returns decImage.         ## Decode an image to a format usable by OpenCV
 ## detectEyes(decImage) returns img, eyesX, eyesY  ## Detects the eyes
+## detectEyesFast(rawImage) returns gray, eyesX, eyesY  ## Detects the eyes without decoding colors or drawing anything
 ## encodeImage (img) returns encImage              ## Encode the image to jpeg
+##
+## detectEyesBatch(frames, workers) does detectEyes on many frames at once using all the cores
+##
+## And the EyeTracker class, whose detectEyes(decImage) does the same on consecutive frames 
+## of a video stream, following the face instead of looking for it on the whole image
 
 ####################################################################################################
 ## This module can be run to detect eyes on a video stream if it is called once per frame. 
@@ -40,6 +46,10 @@
 
 ####################################################################################################
 import cv2
+import numpy as np
+import multiprocessing
+import time
+import threading
 ####################################################################################################
 
 
@@ -50,6 +60,47 @@ def decodeImage(img):
     ## Most common image formats are supported, including png, jpeg, tif, bmp
     decImg = cv2.imdecode(img, 1)
     return decImg
+
+
+####################################################################################################
+## When only the eye coordinates are needed there is no point in decoding the colors
+## The jpeg decoder can also downscale by 1/2, 1/4 or 1/8 while decoding, almost for free
+## Not available in older OpenCV versions (and ignored by imdecode in some of them), we just decode to full size greyscale then
+reducedGrayscale = [(8, getattr(cv2, 'IMREAD_REDUCED_GRAYSCALE_8', None)),
+                    (4, getattr(cv2, 'IMREAD_REDUCED_GRAYSCALE_4', None)),
+                    (2, getattr(cv2, 'IMREAD_REDUCED_GRAYSCALE_2', None))]
+
+def _checkReducedDecoding():
+    ## Decode a tiny jpeg once to find out whether this OpenCV really downscales while decoding
+    flag = reducedGrayscale[-1][1]
+    if flag is None:
+        return []
+    retval, probe = cv2.imencode(".jpg", np.zeros((16,16), np.uint8))
+    decoded = cv2.imdecode(probe, flag)
+    if decoded is None or decoded.shape != (8,8):
+        return []
+    return reducedGrayscale
+
+reducedGrayscale = _checkReducedDecoding()
+
+def decodeImageGray(img, profile=None):
+    ## Takes byte-encoded image, returns the greyscale, equalized and downscaled image used by the Haar cascades
+    ## Same steps as prepareImage(decodeImage(img)) (greyscale, downscale, equalize) without the full size
+    ## color image in between. The jpeg decoder converts to greyscale (and downscales) on its own, a few pixels
+    ## may differ slightly from cvtColor and cv2.resize
+    ## Returns None if the image could not be decoded
+    if profile is None:
+        profile = defaultProfile
+
+    gray = cv2.imdecode(img, profile.decodeFlag)
+    if gray is None:
+        return None
+
+    ## Whatever is left of the scaling after decoding
+    if profile.decodeResize != 1.0:
+        gray = cv2.resize(gray, (0,0), fx=profile.decodeResize, fy=profile.decodeResize)
+    gray = cv2.equalizeHist(gray)
+    return gray
     
     
 
@@ -58,9 +109,29 @@ def decodeImage(img):
 ## This and other Haar classifiers can be obtained from https://github.com/Itseez/opencv/tree/master/data/haarcascades
 ## Frontal face is used to detect faces looking frontally into the image. 
 ## It will not detect the face if tilted or not frontal
-face_cascade = cv2.CascadeClassifier('haarCascadesXML/haarcascade_frontalface_default.xml')
-## eye_cascade
-eye_cascade = cv2.CascadeClassifier('haarCascadesXML/haarcascade_eye.xml')
+faceCascadeFile = 'haarCascadesXML/haarcascade_frontalface_default.xml'
+eyeCascadeFile = 'haarCascadesXML/haarcascade_eye.xml'
+
+## OpenCV classifiers are not thread safe, two threads running detectMultiScale on the same one
+## fail randomly. Every thread (the server workers...) gets its own, loaded the first time it needs them
+threadCascades = threading.local()
+
+def loadCascades():
+    global face_cascade, eye_cascade
+    face_cascade = cv2.CascadeClassifier(faceCascadeFile)
+    ## eye_cascade
+    eye_cascade = cv2.CascadeClassifier(eyeCascadeFile)
+    threadCascades.face = face_cascade
+    threadCascades.eye = eye_cascade
+
+def cascades():
+    ## Haar cascades of the calling thread: .face and .eye
+    if not hasattr(threadCascades, 'face'):
+        threadCascades.face = cv2.CascadeClassifier(faceCascadeFile)
+        threadCascades.eye = cv2.CascadeClassifier(eyeCascadeFile)
+    return threadCascades
+
+loadCascades()
 
 ## Optionally we could try to use other databases
 ## Detecting left and right eyes independently sounds like a great idea but didn't perform well during this particular application
@@ -68,147 +139,757 @@ eye_cascade = cv2.CascadeClassifier('haarCascadesXML/haarcascade_eye.xml')
 #eye_right_cascade = cv2.CascadeClassifier('haarCascadesXML/haarcascade_mcs_righteye.xml')
 #eye_left_cascade = cv2.CascadeClassifier('haarCascadesXML/haarcascade_mcs_lefteye.xml')
 
-# Reduce scale of the image when processing to compute faster. 
-# This module has been tested with images that were already very low quality (few kb, 20% jpeg compression, 240p)
-# Therefore too much scaling down is not required, and could actually screw things up
-# 0.7 seems to be quite a good value
-scale = 0.7
-
 ## Hardcoded RGB colors to play with for drawing rectangles around the eyes
 green =  ( 0   , 255  , 0     )
 red   =  ( 0   , 0    , 255   )
 blue  =  ( 255 , 0    , 0     )
 
-## Haar detectors take as input maximum and minimum expected area of the pattern to detect
-## Adjust to scale
-## This sizes are optimized for images taken from a webcam in front of the user
-## Other kind of images may have different scales
-faceMinSize = int(60*scale)
-faceMaxSize = int(300*scale)
-eyesMinSize = int(12*scale)
-eyesMaxSize = int(40*scale)
 
+####################################################################################################
+## Detector profiles
+## Everything the detection can be tuned with lives in a DetectorProfile, given to the functions below (profile=...)
+## Functions called without a profile use defaultProfile
+## The values derived from the parameters (sizes depending on scale, jpeg params...) are computed once
+## when the profile is made, not on every frame. Profiles are shared, don't change them, make a copy
+class DetectorProfile(object):
+
+    parameterNames = ('scale', 'faceScaleFactor', 'faceMinNeighbors', 'eyesScaleFactor', 'eyesMinNeighbors',
+                      'faceMinSize', 'faceMaxSize', 'eyesMinSize', 'eyesMaxSize', 'eyesSearch', 'eyesCoarseScaleFactor', 'jpegQuality')
+
+    def __init__(self, name='custom', scale=0.7, faceScaleFactor=1.05, faceMinNeighbors=6, eyesScaleFactor=1.01, eyesMinNeighbors=3,
+                 faceMinSize=60, faceMaxSize=300, eyesMinSize=12, eyesMaxSize=40, eyesSearch='full', eyesCoarseScaleFactor=1.1,
+                 jpegQuality=15):
+        self.name = name
+
+        # Reduce scale of the image when processing to compute faster.
+        # The default has been tested with images that were already very low quality (few kb, 20% jpeg compression, 240p)
+        # Therefore too much scaling down is not required, and could actually screw things up
+        # 0.7 seems to be quite a good value for those
+        self.scale = scale
+
+        ## Haar detectors parameters, found by trial and error
+        ## scaleFactor: how much the image shrinks between two scales searched, the closer to 1 the slower and the more thorough
+        ## minNeighbors: how many overlapping detections it takes to keep one, higher means less false positives
+        ## Eyes are small and need a very thorough (expensive) search
+        self.faceScaleFactor = faceScaleFactor
+        self.faceMinNeighbors = faceMinNeighbors
+        self.eyesScaleFactor = eyesScaleFactor
+        self.eyesMinNeighbors = eyesMinNeighbors
+
+        ## Haar detectors take as input maximum and minimum expected area of the pattern to detect
+        ## Given here in pixels of the original image, adjusted to scale below
+        ## The default sizes are optimized for images taken from a webcam in front of the user
+        ## Other kind of images may have different scales
+        self.faceMinSize = faceMinSize
+        self.faceMaxSize = faceMaxSize
+        self.eyesMinSize = eyesMinSize
+        self.eyesMaxSize = eyesMaxSize
+
+        ## How findEyes looks for the eyes inside the face
+        ## full: one thorough search of the whole face at eyesScaleFactor
+        ## coarse: a quick search at eyesCoarseScaleFactor, refined at eyesScaleFactor around what it found (see findEyesCoarseToFine)
+        if eyesSearch not in ('full', 'coarse'):
+            raise ValueError('Unknown eyes search ' + str(eyesSearch))
+        self.eyesSearch = eyesSearch
+        self.eyesCoarseScaleFactor = eyesCoarseScaleFactor
+
+        ## Quality of the jpeg images sent back by encodeImage
+        self.jpegQuality = jpegQuality
+
+        ## Derived values, used as is by detectMultiScale, imencode and imdecode
+        self.faceMin = (int(faceMinSize*scale), int(faceMinSize*scale))
+        self.faceMax = (int(faceMaxSize*scale), int(faceMaxSize*scale))
+        self.eyesMin = (int(eyesMinSize*scale), int(eyesMinSize*scale))
+        self.eyesMax = (int(eyesMaxSize*scale), int(eyesMaxSize*scale))
+        self.jpegParams = [int(cv2.IMWRITE_JPEG_QUALITY), jpegQuality]
+
+        ## decodeImageGray: smallest reduction the jpeg decoder can do without going under scale,
+        ## and whatever is left of the scaling after decoding
+        self.decodeFlag = cv2.IMREAD_GRAYSCALE
+        factor = 1
+        for (reduction, reducedFlag) in reducedGrayscale:
+            if 1.0/reduction >= scale:
+                self.decodeFlag = reducedFlag
+                factor = reduction
+                break
+        self.decodeResize = scale*factor
+
+    def parameters(self):
+        ## Parameters of this profile, as a dict that can be given back to DetectorProfile
+        return dict((name, getattr(self, name)) for name in self.parameterNames)
+
+    def copy(self, name='custom', **changes):
+        ## New profile with the same parameters except changes, e.g. profile.copy(scale=0.5, eyesScaleFactor=1.05)
+        for key in changes:
+            if key not in self.parameterNames:
+                raise ValueError('Unknown detector parameter ' + key)
+        parameters = self.parameters()
+        parameters.update(changes)
+        return DetectorProfile(name, **parameters)
+
+    def __repr__(self):
+        return 'DetectorProfile(%r, %s)' % (self.name, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.parameterNames))
+
+
+## Profiles clients can choose by name
+## low: tiny frames (less than 240p), not downscaled at all, faces are only a few dozen pixels
+## default: 240p-480p webcam images, what this module has always been tuned for
+## hd: 720p and more, faces are much bigger in pixels so the image can be downscaled a lot more
+##     The range of eye sizes is wide, the coarse to fine eye search saves the most there
+profiles = {
+    'low': DetectorProfile('low', scale=1.0, faceMinSize=40, faceMaxSize=240, eyesMinSize=8, eyesMaxSize=30),
+    'default': DetectorProfile('default'),
+    'hd': DetectorProfile('hd', scale=0.35, faceMinSize=120, faceMaxSize=720, eyesMinSize=24, eyesMaxSize=100, eyesSearch='coarse'),
+}
+defaultProfile = profiles['default']
+
+def profileForResolution(width, height):
+    ## Best suited profile for images of width x height
+    if height < 240:
+        return profiles['low']
+    if height < 720:
+        return profiles['default']
+    return profiles['hd']
 
-def detectEyes(img):
-    ## Takes OpenCV formatted image, converts it to greyscale, detects eyes
-    ## Returns eyesX, eyesY coordinates, image with green rectangles around eyes
 
-    # Initialize eyes location to -1 (not found)
-    # If we find them, we will change this value
-    eyesX = -1
-    eyesY = -1
+####################################################################################################
+def prepareImage(img, profile=None):
+    ## Takes OpenCV formatted image, returns the greyscale, equalized and downscaled version of it
+    ## that both Haar cascades work on
+    if profile is None:
+        profile = defaultProfile
 
-    # Convert to grey and equalize 
+    # Convert to grey
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.equalizeHist(gray)
     # Make image smaller
     ## Resizing image to improve performance is generally very stupid
     ## The resizing itself takes some time
     ## However Haar detectors are very CPU intensive
     ## And it scales exponentially with area
     ## Performance comparisons show this makes sense here
-    gray = cv2.resize(gray, (0,0), fx=scale, fy=scale)
+    gray = cv2.resize(gray, (0,0), fx=profile.scale, fy=profile.scale)
+    # Equalize the small image, less work and the same order as decodeImageGray:
+    # both paths must give the cascades the same image
+    gray = cv2.equalizeHist(gray)
+    return gray
+
+
+####################################################################################################
+def findFace(gray, window=None, profile=None):
+    ## Looks for faces in the downscaled greyscale image
+    ## window (x, y, w, h) optionally restricts the search to a part of the image
+    ## Returns the face of maximum area as (x, y, w, h) in downscaled image coordinates, None if not found
+    if profile is None:
+        profile = defaultProfile
+    (wx, wy) = (0, 0)
+    if window is not None:
+        (wx, wy, ww, wh) = window
+        gray = gray[wy:wy+wh, wx:wx+ww]
 
     ## Initialize Haar cascade to detect human faces 
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.05, minNeighbors=6, minSize=(faceMinSize, faceMinSize), maxSize=(faceMaxSize, faceMaxSize)) 
+    faces = cascades().face.detectMultiScale(gray, scaleFactor=profile.faceScaleFactor, minNeighbors=profile.faceMinNeighbors, minSize=profile.faceMin, maxSize=profile.faceMax)
 
     # It may have found more than one face (Sometimes small background complex patterns sneak in as faces)
     # Just take the face of maximum area	
-    foundFlag = False
-    if (list(faces)):
-        areaFaceFound = 0
-        for (x,y,w,h) in faces:
-            if (w*h > areaFaceFound):
-                foundFace =  [[x,y,w,h]]
-        foundFlag = True
-
-        ## I know, it seems like foundFlag is always true, but strange bugs when it's not checked 
-        if (foundFlag):
-            ## We should have detected ONE face at this point
-            for (x,y,w,h) in foundFace:
-                ## Take ROI (Region of Interest) of the face only, so we don't look for eyes outside the face
-                roi_gray = gray[y:int(y+(0.7*h)), int(x + (0.0*w)):int(x + (1.0*w))]
-                roi_gray = cv2.equalizeHist(roi_gray)
-
-                ## Draw rectangle around face in color image img
-                roi_color = img[int(y/scale):int((y+h)/scale), int(x/scale):int((x+w)/scale)]
-                cv2.rectangle(img,(int(x/scale),int(y/scale)),(int((x+w)/scale),int((y+h)/scale)),green,1)
-
-                ## DETECT EYES INSIDE FACE AREA
-                ## 3 methods have been tried
-                ## 1) Look for eyes one by one with a general pattern, without taking right and left eye shape differences into account
-                ## 2) Look for eye pairs (one pattern consisting of the two eyes)
-                ## 3) Look for right eyes and left eyes using a different pattern for each eye
-        # ########################################################################################################
-        # 1
-        # Detecting all eyes in the face region at the same time
-        # This seems like the less logical way to do it
-        # But somehow it is the most stable		
-        
-                eyes = eye_cascade.detectMultiScale(roi_gray, scaleFactor= 1.01, minSize=(eyesMinSize,eyesMinSize), maxSize=(eyesMaxSize,eyesMaxSize))
-                
-        if (len(eyes) == 2): 
-                ## Great, we found exactly two eyes. If more or less we return without detecting eyes (something went wrong)
-                for (ex,ey,ew,eh) in eyes:
-                        ## Draw a rectangle around each eye in color image img
-                        cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+ew)/scale),int((ey+eh)/scale)),green,2)
-
-
-            ## We have detected the eyes
-            ## Translate local coordinates (respective to the face ROI) into image coordinates
-
-            (faceX, faceY, faceW, faceH) = (x,y,w,h)
-            (aX,aY, aW, aH) = eyes[0]
-            (bX,bY, bW, bH) = eyes[1]
-            aX = int(aX + 0.5*aW)
-            aY = int(aY + 0.5*aH)
-            bX = int(bX + 0.5*bW)
-            bY = int(bY + 0.5*bH)
-
-            eyesX = faceX + int( 0.5 * (aX+bX))
-            eyesY = faceY + int( 0.5 * (aY+bY))
-            eyesX = int(eyesX/scale)
-            eyesY = int(eyesY/scale)
-        
-        # ######################################################################################################
-        # 2
-        # Detecting two pairs at the same time in pairs would make much more sense
-        # But it is extremely unstable, giving segfaults out of nowhere as soon as we change anything
-        # Maybe there is something wrong with the XML file for eyepairs?
-        #
-        # eyes_pair = eye_pair_cascade.detectMultiScale(roi_gray, scaleFactor= 1.01)
-                # for (ex,ey,ew,eh) in eyes_pair:
-                    #cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+eh)/scale),int((ey+ew)/scale)),green,2)
-
-        # ######################################################################################################
-        # 3
-        # Detecting both eyes separetely with two different Haar cascades (a separate XML file for left and right) would also make sense
-        # But if we can get by using only one detector and it works, why use 2?
-        #
-                # roi_gray_left = gray[y:int(y+(0.7*h)), x:int(x+(0.5*w))]
-                # roi_gray_left = cv2.equalizeHist(roi_gray_left)
-                #
-                # roi_gray_right = gray[y:int(y+(0.7*h)), int(x+(0.5*w)):x+w]
-                # roi_gray_right = cv2.equalizeHist(roi_gray_right)
-                #
-                # eyes_left = eye_cascade_left.detectMultiScale(roi_gray_left, scaleFactor=1.01, minSize=(eyesMinSize,eyesMinSize))
-                # for (ex,ey,ew,eh) in eyes_left:
-                # 	cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+ew)/scale),int((ey+eh)/scale)),blue,2)
-                #
-                # eyes_right = eye_cascade_right.detectMultiScale(roi_gray_right, scaleFactor=1.01, minSize=(eyesMinSize,eyesMinSize))
-                # for (ex,ey,ew,eh) in eyes_right:
-                # 	cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+ew)/scale),int((ey+eh)/scale)),red,2)
+    foundFace = None
+    areaFaceFound = 0
+    for (x,y,w,h) in faces:
+        if (w*h > areaFaceFound):
+            areaFaceFound = w*h
+            foundFace = (int(x + wx), int(y + wy), int(w), int(h))
+    return foundFace
+
+
+####################################################################################################
+def findEyes(gray, face, profile=None):
+    ## Looks for the eyes inside the face found by findFace
+    ## Returns the two eyes as (x, y, w, h) relative to the face ROI, None unless exactly two are found
+    if profile is None:
+        profile = defaultProfile
+    (x,y,w,h) = face
+
+    ## Take ROI (Region of Interest) of the face only, so we don't look for eyes outside the face
+    roi_gray = gray[y:int(y+(0.7*h)), int(x + (0.0*w)):int(x + (1.0*w))]
+    roi_gray = cv2.equalizeHist(roi_gray)
+
+    ## DETECT EYES INSIDE FACE AREA
+    ## 3 methods have been tried
+    ## 1) Look for eyes one by one with a general pattern, without taking right and left eye shape differences into account
+    ## 2) Look for eye pairs (one pattern consisting of the two eyes)
+    ## 3) Look for right eyes and left eyes using a different pattern for each eye
+    # ########################################################################################################
+    # 1
+    # Detecting all eyes in the face region at the same time
+    # This seems like the less logical way to do it
+    # But somehow it is the most stable		
+    if profile.eyesSearch == 'coarse':
+        return findEyesCoarseToFine(roi_gray, profile)
+    eyes = cascades().eye.detectMultiScale(roi_gray, scaleFactor=profile.eyesScaleFactor, minNeighbors=profile.eyesMinNeighbors, minSize=profile.eyesMin, maxSize=profile.eyesMax)
+
+    ## Great, we found exactly two eyes. If more or less we return without detecting eyes (something went wrong)
+    if (len(eyes) == 2): 
+        return eyes
+    return None
+
+    # ######################################################################################################
+    # 2
+    # Detecting two pairs at the same time in pairs would make much more sense
+    # But it is extremely unstable, giving segfaults out of nowhere as soon as we change anything
+    # Maybe there is something wrong with the XML file for eyepairs?
+    #
+    # eyes_pair = eye_pair_cascade.detectMultiScale(roi_gray, scaleFactor= 1.01)
+    # for (ex,ey,ew,eh) in eyes_pair:
+    #     cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+eh)/scale),int((ey+ew)/scale)),green,2)
+
+    # ######################################################################################################
+    # 3
+    # Detecting both eyes separetely with two different Haar cascades (a separate XML file for left and right) would also make sense
+    # But if we can get by using only one detector and it works, why use 2?
+    #
+    # roi_gray_left = gray[y:int(y+(0.7*h)), x:int(x+(0.5*w))]
+    # roi_gray_left = cv2.equalizeHist(roi_gray_left)
+    #
+    # roi_gray_right = gray[y:int(y+(0.7*h)), int(x+(0.5*w)):x+w]
+    # roi_gray_right = cv2.equalizeHist(roi_gray_right)
+    #
+    # eyes_left = eye_cascade_left.detectMultiScale(roi_gray_left, scaleFactor=1.01, minSize=(eyesMinSize,eyesMinSize))
+    # for (ex,ey,ew,eh) in eyes_left:
+    # 	cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+ew)/scale),int((ey+eh)/scale)),blue,2)
+    #
+    # eyes_right = eye_cascade_right.detectMultiScale(roi_gray_right, scaleFactor=1.01, minSize=(eyesMinSize,eyesMinSize))
+    # for (ex,ey,ew,eh) in eyes_right:
+    # 	cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+ew)/scale),int((ey+eh)/scale)),red,2)
+
+
+####################################################################################################
+## Coarse to fine eye search (profile eyesSearch='coarse')
+## Searching the whole face at eyesScaleFactor 1.01 means running the cascade on a huge number of pyramid levels
+## A quick search at eyesCoarseScaleFactor (few levels, minNeighbors 1) finds roughly where the eyes are,
+## the thorough search then only runs in a small window around them, at sizes close to the ones found
+## Each half of the face must hold exactly one eye (same contract as the full search: two eyes or nothing)
+## A half where the quick search found nothing, or where the refinement failed, is searched on its own
+def findEyesCoarseToFine(roi_gray, profile):
+    ## roi_gray: equalized face ROI, as searched by findEyes
+    ## Returns the two eyes as (x, y, w, h) relative to the face ROI, None unless one eye is found in each half
+    (height, width) = roi_gray.shape
+    candidates = cascades().eye.detectMultiScale(roi_gray, scaleFactor=profile.eyesCoarseScaleFactor, minNeighbors=1, minSize=profile.eyesMin, maxSize=profile.eyesMax)
+
+    eyes = []
+    for (x0, x1) in ((0, width//2), (width//2, width)):
+        inHalf = [c for c in candidates if x0 <= c[0] + c[2]//2 < x1]
+        eye = None
+        if inHalf:
+            eye = refineEye(roi_gray, max(inHalf, key=lambda c: c[2]*c[3]), profile)
+        if eye is None:
+            eye = searchHalf(roi_gray, (x0, 0, x1 - x0, height), profile)
+        if eye is None:
+            ## No need to look for the other eye
+            return None
+        eyes.append(eye)
+    return np.array(eyes)
+
+def refineEye(roi_gray, candidate, profile):
+    ## Thorough search in a window around candidate, for eyes of about the candidate's size
+    ## Returns the eye closest to the candidate, None if there is none
+    (cx, cy, cw, ch) = candidate
+    margin = cw//4
+    x0 = max(0, cx - margin)
+    y0 = max(0, cy - margin)
+    x1 = min(roi_gray.shape[1], cx + cw + margin)
+    y1 = min(roi_gray.shape[0], cy + ch + margin)
+
+    ## The coarse pyramid levels are eyesCoarseScaleFactor apart, the real size is at most one level away
+    ## Every pyramid level costs, the narrower the size range the fewer levels are searched
+    step = profile.eyesCoarseScaleFactor
+    minSize = max(profile.eyesMin[0], int(cw/step))
+    maxSize = max(minSize, min(profile.eyesMax[0], int(np.ceil(cw*step))))
+    found = cascades().eye.detectMultiScale(roi_gray[y0:y1, x0:x1], scaleFactor=profile.eyesScaleFactor, minNeighbors=profile.eyesMinNeighbors, minSize=(minSize, minSize), maxSize=(maxSize, maxSize))
+    if len(found) == 0:
+        return None
+
+    center = (cx + cw/2.0 - x0, cy + ch/2.0 - y0)
+    (ex, ey, ew, eh) = min(found, key=lambda e: (e[0] + e[2]/2.0 - center[0])**2 + (e[1] + e[3]/2.0 - center[1])**2)
+    return (x0 + ex, y0 + ey, ew, eh)
+
+def searchHalf(roi_gray, half, profile):
+    ## Thorough search of one half of the face, returns its eye if exactly one is found
+    (x0, y0, w, h) = half
+    found = cascades().eye.detectMultiScale(roi_gray[y0:y0+h, x0:x0+w], scaleFactor=profile.eyesScaleFactor, minNeighbors=profile.eyesMinNeighbors, minSize=profile.eyesMin, maxSize=profile.eyesMax)
+    if len(found) != 1:
+        return None
+    (ex, ey, ew, eh) = found[0]
+    return (x0 + ex, y0 + ey, ew, eh)
+
+
+####################################################################################################
+def eyesCenter(face, eyes, profile=None):
+    ## Translate local eye coordinates (respective to the face ROI) into image coordinates
+    ## Returns eyesX, eyesY: the point between both eyes in the original image, -1 if not found
+    if face is None or eyes is None:
+        return -1, -1
+    if profile is None:
+        profile = defaultProfile
+
+    (faceX, faceY, faceW, faceH) = face
+    (aX,aY, aW, aH) = eyes[0]
+    (bX,bY, bW, bH) = eyes[1]
+    aX = int(aX + 0.5*aW)
+    aY = int(aY + 0.5*aH)
+    bX = int(bX + 0.5*bW)
+    bY = int(bY + 0.5*bH)
+
+    eyesX = faceX + int( 0.5 * (aX+bX))
+    eyesY = faceY + int( 0.5 * (aY+bY))
+    eyesX = int(eyesX/profile.scale)
+    eyesY = int(eyesY/profile.scale)
+    return eyesX, eyesY
+
+
+####################################################################################################
+def imageBoxes(face, eyes, profile=None):
+    ## Translate the face and eyes found by findFace and findEyes into image coordinates
+    ## Returns faceBox [x, y, w, h] (None if not found), eyeBoxes [[x, y, w, h], [x, y, w, h]] ([] if not found)
+    ## All plain python ints, ready to be sent to the client
+    if face is None:
+        return None, []
+    if profile is None:
+        profile = defaultProfile
+
+    scale = profile.scale
+    (x,y,w,h) = face
+    faceBox = [int(x/scale), int(y/scale), int(w/scale), int(h/scale)]
+    eyeBoxes = []
+    if eyes is not None:
+        for (ex,ey,ew,eh) in eyes:
+            eyeBoxes.append([int((x+ex)/scale), int((y+ey)/scale), int(ew/scale), int(eh/scale)])
+    return faceBox, eyeBoxes
+
+
+####################################################################################################
+def drawDetection(img, face, eyes, profile=None):
+    ## Draws green rectangles around the face and the eyes in color image img
+    if face is None:
+        return img
+    if profile is None:
+        profile = defaultProfile
 
+    scale = profile.scale
+    (x,y,w,h) = face
+    roi_color = img[int(y/scale):int((y+h)/scale), int(x/scale):int((x+w)/scale)]
+    cv2.rectangle(img,(int(x/scale),int(y/scale)),(int((x+w)/scale),int((y+h)/scale)),green,1)
+
+    if eyes is not None:
+        for (ex,ey,ew,eh) in eyes:
+            ## Draw a rectangle around each eye in color image img
+            cv2.rectangle(roi_color,(int(ex/scale),int(ey/scale)),(int((ex+ew)/scale),int((ey+eh)/scale)),green,2)
+    return img
+
+
+####################################################################################################
+def drawBoxes(img, faceBox, eyeBoxes):
+    ## Same as drawDetection, for boxes already in image coordinates (imageBoxes, predicted boxes...)
+    if faceBox is None:
+        return img
+
+    (x,y,w,h) = faceBox
+    cv2.rectangle(img,(x,y),(x+w,y+h),green,1)
+    for (ex,ey,ew,eh) in eyeBoxes:
+        cv2.rectangle(img,(ex,ey),(ex+ew,ey+eh),green,2)
+    return img
+
+
+####################################################################################################
+## Timing hooks
+## The functions below optionally take stats, any object with record(stage, seconds) and count(name)
+## (pipelineStats.PipelineStats for example). Stages: prepare, decode, gate (EyeTracker motion gate), face, eyes,
+## match (EyeTracker eye templates), draw
+## Counters: frames, faces (frames with a face), eyes (frames with both eyes), noDetection (frames without eyes),
+## eyeMatches (frames where the EyeTracker found the eyes without running the cascades),
+## gateHits, gateMisses (frames the EyeTracker motion gate found static, not static)
+def _recordSince(stats, stage, start):
+    if stats is not None:
+        stats.record(stage, time.time() - start)
+
+def _recordDetection(stats, face, eyes, start, faceDone):
+    if stats is None:
+        return
+    stats.record('face', faceDone - start)
+    stats.count('frames')
+    if face is not None:
+        stats.record('eyes', time.time() - faceDone)
+        stats.count('faces')
+    if eyes is not None:
+        stats.count('eyes')
+    else:
+        stats.count('noDetection')
+
+def _recordMatch(stats, start):
+    if stats is None:
+        return
+    stats.record('match', time.time() - start)
+    stats.count('frames')
+    stats.count('faces')
+    stats.count('eyes')
+    stats.count('eyeMatches')
+
+
+####################################################################################################
+def locateEyes(gray, stats=None, profile=None):
+    ## Takes the image returned by prepareImage or decodeImageGray
+    ## Returns face, eyes as found by findFace and findEyes (None if not found)
+    start = time.time()
+    eyes = None
+    face = findFace(gray, profile=profile)
+    faceDone = time.time()
+    if face is not None:
+        eyes = findEyes(gray, face, profile)
+    _recordDetection(stats, face, eyes, start, faceDone)
+    return face, eyes
+
+
+####################################################################################################
+def detectEyes(img, stats=None, profile=None):
+    ## Takes OpenCV formatted image, converts it to greyscale, detects eyes
+    ## Returns eyesX, eyesY coordinates, image with green rectangles around eyes
+    ## Every call scans the whole image, use an EyeTracker to follow the face of a video stream
+    start = time.time()
+    gray = prepareImage(img, profile)
+    _recordSince(stats, 'prepare', start)
+
+    face, eyes = locateEyes(gray, stats, profile)
+
+    start = time.time()
+    drawDetection(img, face, eyes, profile)
+    _recordSince(stats, 'draw', start)
+
+    eyesX, eyesY = eyesCenter(face, eyes, profile)
     return img, eyesX, eyesY
 
+
+####################################################################################################
+def detectEyesFast(img, stats=None, profile=None):
+    ## Detection only fast path: takes the byte-encoded image as received, nothing is drawn
+    ## The image is decoded straight to downscaled greyscale, no full size color image is ever made
+    ## Returns gray, eyesX, eyesY. gray is the image the detection ran on, None if it could not be decoded
+    start = time.time()
+    gray = decodeImageGray(img, profile)
+    _recordSince(stats, 'decode', start)
+    if gray is None:
+        return None, -1, -1
+
+    face, eyes = locateEyes(gray, stats, profile)
+    eyesX, eyesY = eyesCenter(face, eyes, profile)
+    return gray, eyesX, eyesY
+
+
+####################################################################################################
+## A webcam user's face barely moves between two consecutive frames of a video stream
+## Scanning the whole image for faces on every frame is where most of the CPU time goes
+## An EyeTracker remembers the face found on the previous frame and only looks for it
+## in a window around its previous position.
+## The whole image is scanned again when the face is lost, and every refreshInterval frames
+## in case a bigger face (the real one) appeared somewhere else.
+## One EyeTracker should be used per video stream (per websocket connection), with the profile of that stream
+##
+## With trackEyes the eyes themselves are followed too: the patches of the last eyes found by the cascades are
+## looked for in the next frames with a template match, in a small window around their previous position.
+## That is a couple of tiny matchTemplate calls instead of the face and eye cascades.
+## The cascades run again when a match is not good enough (below matchThreshold), when both eyes don't move
+## together, and at least every eyesRefreshInterval frames (the templates get stale, the face gets closer...)
+##
+## With motionGate, a frame that barely differs from the one of the last detection (in the region of the face
+## found then, the whole image if there was none) gets the same result, nothing else runs at all
+## Users often sit still in front of their webcam, many frames are static
+class EyeTracker(object):
+
+    def __init__(self, refreshInterval=30, searchMargin=0.5, stats=None, profile=None, trackEyes=False, matchThreshold=0.7, eyesRefreshInterval=10,
+                 motionGate=False, motionThreshold=3.0):
+        ## refreshInterval: maximum number of frames between two full image scans
+        ## searchMargin: the search window is the previous face (or eye) grown by this fraction of its size on each side
+        ## stats: optional, gets the time spent in every stage (see Timing hooks)
+        ## profile: DetectorProfile used for every frame, defaultProfile if not given
+        ## trackEyes: follow the eyes by template matching between cascade detections
+        ## matchThreshold: minimum normalized correlation (-1 to 1) of a template match
+        ## eyesRefreshInterval: maximum number of frames the eyes are followed without running the cascades
+        ## motionGate: reuse the previous result for frames that did not change
+        ## motionThreshold: mean absolute difference of the grey levels (0-255) under which a frame did not change
+        self.refreshInterval = refreshInterval
+        self.searchMargin = searchMargin
+        self.stats = stats
+        self.profile = profile if profile is not None else defaultProfile
+        self.trackEyes = trackEyes
+        self.matchThreshold = matchThreshold
+        self.eyesRefreshInterval = eyesRefreshInterval
+        self.motionGate = motionGate
+        self.motionThreshold = motionThreshold
+
+        self.face = None          ## Face found on the previous frame, downscaled image coordinates
+        self.framesSinceScan = 0  ## Frames processed since the last full image scan
+        self.eyePatches = None    ## trackEyes: images of the eyes last found by the cascades, the templates
+        self.eyeBoxes = None      ## trackEyes: where the eyes were on the previous frame, downscaled image coordinates
+        self.framesSinceEyeScan = 0
+        self.gateFrame = None     ## motionGate: image of the last frame really processed
+        self.gateResult = None    ## motionGate: face, eyes found in it
+
+        ## Counters, mostly useful to tune refreshInterval and searchMargin
+        self.fullScans = 0
+        self.windowScans = 0
+        self.lostFaces = 0
+        self.eyeMatches = 0
+        self.lostEyes = 0
+        self.gateHits = 0
+        self.gateMisses = 0
+
+    def reset(self):
+        ## Forget the previous face, next frame does a full image scan
+        self.face = None
+        self.framesSinceScan = 0
+        self.eyePatches = None
+        self.eyeBoxes = None
+        self.gateFrame = None
+        self.gateResult = None
+
+    def setProfile(self, profile):
+        ## Change the profile of the stream. The previous face was found at another scale, forget it
+        self.profile = profile
+        self.reset()
+
+    def searchWindow(self, shape):
+        ## Previous face grown by searchMargin on each side, clipped to the image
+        (x,y,w,h) = self.face
+        marginX = int(self.searchMargin*w)
+        marginY = int(self.searchMargin*h)
+        x0 = max(0, x - marginX)
+        y0 = max(0, y - marginY)
+        x1 = min(shape[1], x + w + marginX)
+        y1 = min(shape[0], y + h + marginY)
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def locateFace(self, gray):
+        ## Returns the face in the downscaled greyscale image, None if not found
+        face = None
+        if self.face is not None and self.framesSinceScan < self.refreshInterval:
+            self.windowScans += 1
+            self.framesSinceScan += 1
+            face = findFace(gray, self.searchWindow(gray.shape), self.profile)
+            if face is None:
+                self.lostFaces += 1
+
+        if face is None:
+            ## No previous face, face lost or time for a refresh: scan the whole image
+            self.fullScans += 1
+            self.framesSinceScan = 0
+            face = findFace(gray, profile=self.profile)
+
+        self.face = face
+        return face
+
+    def storeEyes(self, gray, face, eyes):
+        ## Keeps the eyes just found by the cascades as the templates of the next frames
+        if eyes is None:
+            self.eyePatches = None
+            self.eyeBoxes = None
+            return
+        (x,y,w,h) = face
+        self.eyeBoxes = [(int(x+ex), int(y+ey), int(ew), int(eh)) for (ex,ey,ew,eh) in eyes]
+        self.eyePatches = [gray[by:by+bh, bx:bx+bw].copy() for (bx,by,bw,bh) in self.eyeBoxes]
+        self.framesSinceEyeScan = 0
+
+    def matchEye(self, gray, patch, box):
+        ## Best match of patch around box (previous position of the eye), None if not good enough
+        (x,y,w,h) = box
+        margin = max(2, int(self.searchMargin*w))
+        x0 = max(0, x - margin)
+        y0 = max(0, y - margin)
+        x1 = min(gray.shape[1], x + w + margin)
+        y1 = min(gray.shape[0], y + h + margin)
+        if x1 - x0 < w or y1 - y0 < h:
+            return None
+
+        scores = cv2.matchTemplate(gray[y0:y1, x0:x1], patch, cv2.TM_CCOEFF_NORMED)
+        (minScore, maxScore, minLoc, maxLoc) = cv2.minMaxLoc(scores)
+        if maxScore < self.matchThreshold:
+            return None
+        return (x0 + maxLoc[0], y0 + maxLoc[1], w, h)
+
+    def matchEyes(self, gray):
+        ## Finds the eyes of the previous frame in gray without the cascades
+        ## Returns face, eyes like locateEyes, the face being moved along with the eyes. None, None if lost
+        boxes = []
+        for (patch, box) in zip(self.eyePatches, self.eyeBoxes):
+            found = self.matchEye(gray, patch, box)
+            if found is None:
+                return None, None
+            boxes.append(found)
+
+        ## Both eyes move together, if not one of them matched something else (an eyebrow...)
+        moves = [(bx - px, by - py) for ((bx,by,bw,bh), (px,py,pw,ph)) in zip(boxes, self.eyeBoxes)]
+        if abs(moves[0][0] - moves[1][0]) > boxes[0][2]//4 or abs(moves[0][1] - moves[1][1]) > boxes[0][3]//4:
+            return None, None
+
+        (x,y,w,h) = self.face
+        face = (max(0, x + (moves[0][0] + moves[1][0])//2), max(0, y + (moves[0][1] + moves[1][1])//2), w, h)
+        eyes = np.array([(bx - face[0], by - face[1], bw, bh) for (bx,by,bw,bh) in boxes])
+        self.face = face
+        self.eyeBoxes = boxes
+        return face, eyes
+
+    def isStatic(self, gray):
+        ## motionGate: whether gray barely differs from the last frame processed, where the face was
+        if self.gateFrame is None or self.gateFrame.shape != gray.shape:
+            return False
+        face = self.gateResult[0]
+        if face is None:
+            (x, y, w, h) = (0, 0, gray.shape[1], gray.shape[0])
+        else:
+            (x, y, w, h) = face
+        difference = cv2.absdiff(gray[y:y+h, x:x+w], self.gateFrame[y:y+h, x:x+w])
+        return cv2.mean(difference)[0] <= self.motionThreshold
+
+    def gate(self, gray):
+        ## Motion gate, returns the previous face, eyes if the frame is static, None otherwise
+        start = time.time()
+        static = self.isStatic(gray)
+        if self.stats is not None:
+            self.stats.record('gate', time.time() - start)
+            self.stats.count('gateHits' if static else 'gateMisses')
+        if not static:
+            self.gateMisses += 1
+            return None
+        self.gateHits += 1
+        if self.stats is not None:
+            self.stats.count('frames')
+            face, eyes = self.gateResult
+            if face is not None:
+                self.stats.count('faces')
+            self.stats.count('eyes' if eyes is not None else 'noDetection')
+        return self.gateResult
+
+    def locateEyes(self, gray):
+        ## Same as the module level locateEyes, using the face (and with trackEyes the eyes) found on the previous frame
+        if self.motionGate:
+            result = self.gate(gray)
+            if result is not None:
+                return result
+            face, eyes = self.trackedEyes(gray)
+            self.gateFrame = gray
+            self.gateResult = (face, eyes)
+            return face, eyes
+        return self.trackedEyes(gray)
+
+    def trackedEyes(self, gray):
+        ## locateEyes without the motion gate
+        start = time.time()
+        if self.trackEyes and self.eyePatches is not None and self.framesSinceEyeScan < self.eyesRefreshInterval:
+            self.framesSinceEyeScan += 1
+            face, eyes = self.matchEyes(gray)
+            if eyes is not None:
+                self.eyeMatches += 1
+                _recordMatch(self.stats, start)
+                return face, eyes
+            self.lostEyes += 1
+
+        eyes = None
+        face = self.locateFace(gray)
+        faceDone = time.time()
+        if face is not None:
+            eyes = findEyes(gray, face, self.profile)
+        if self.trackEyes:
+            self.storeEyes(gray, face, eyes)
+        _recordDetection(self.stats, face, eyes, start, faceDone)
+        return face, eyes
+
+    def detectEyes(self, img):
+        ## Same as the module level detectEyes, for consecutive frames of the same video stream
+        ## Returns eyesX, eyesY coordinates, image with green rectangles around eyes
+        start = time.time()
+        gray = prepareImage(img, self.profile)
+        _recordSince(self.stats, 'prepare', start)
+
+        face, eyes = self.locateEyes(gray)
+
+        start = time.time()
+        drawDetection(img, face, eyes, self.profile)
+        _recordSince(self.stats, 'draw', start)
+
+        eyesX, eyesY = eyesCenter(face, eyes, self.profile)
+        return img, eyesX, eyesY
+
+    def detectEyesFast(self, img):
+        ## Same as the module level detectEyesFast, for consecutive frames of the same video stream
+        ## Returns gray, eyesX, eyesY
+        start = time.time()
+        gray = decodeImageGray(img, self.profile)
+        _recordSince(self.stats, 'decode', start)
+        if gray is None:
+            return None, -1, -1
+
+        face, eyes = self.locateEyes(gray)
+        eyesX, eyesY = eyesCenter(face, eyes, self.profile)
+        return gray, eyesX, eyesY
+
 ###############################################################################################################################
-def encodeImage(img):
-    ## Encode into jpeg format
+def encodeImage(img, profile=None):
+    ## Encode into jpeg format, with the quality of the profile
     ## Input: openCV formatted image
     ## Output: Encoded image, retval (error flag)
-    jpg_encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 15]
-    retval, encImg = cv2.imencode(".jpg",img,jpg_encode_param)
+    if profile is None:
+        profile = defaultProfile
+    retval, encImg = cv2.imencode(".jpg",img,profile.jpegParams)
     return retval,encImg
 
 
 
+
+
+###############################################################################################################################
+## Batch processing
+## Offline jobs (recorded sessions...) have lots of frames to process and no reason to do it one by one on a single core
+## detectEyesBatch spreads the frames over a pool of processes, each one with its own Haar cascades
+
+def _initWorker():
+    ## Runs once in every worker process of the pool
+    loadCascades()
+
+def _detectFrame(args):
+    ## Runs in a worker process, returns the detectEyes result for one frame
+    frame, images, profile = args
+    if isinstance(frame, str):
+        frame = np.fromstring(frame, dtype=np.uint8)
+    if frame.ndim == 1 or (frame.ndim == 2 and frame.shape[1] == 1):
+        ## Still encoded (jpeg, png...) as received from the client or as returned by encodeImage
+        if not images:
+            ## Nothing to draw, no need for colors
+            gray, eyesX, eyesY = detectEyesFast(frame, profile=profile)
+            return eyesX, eyesY
+        frame = decodeImage(frame)
+    if frame is None:
+        procImg, eyesX, eyesY = None, -1, -1
+    else:
+        procImg, eyesX, eyesY = detectEyes(frame, profile=profile)
+
+    if images:
+        return procImg, eyesX, eyesY
+    return eyesX, eyesY
+
+def detectEyesBatch(frames, workers=None, images=True, chunksize=4, profile=None):
+    ## Takes a list of frames, either encoded (as sent by the client) or already decoded by decodeImage
+    ## workers: number of processes, defaults to the number of cores. 1 runs everything in this process
+    ## images: when False the annotated images are not sent back from the workers, only the coordinates
+    ## profile: DetectorProfile used for every frame, defaultProfile if not given
+    ## Returns one detectEyes result per frame, in the same order as frames:
+    ## (img, eyesX, eyesY), or (eyesX, eyesY) when images is False. img is None if the frame could not be decoded
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    jobs = [(frame, images, profile) for frame in frames]
+    if workers <= 1:
+        return [_detectFrame(job) for job in jobs]
+
+    pool = multiprocessing.Pool(workers, initializer=_initWorker)
+    try:
+        results = pool.map(_detectFrame, jobs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    return results
@@ -0,0 +1,185 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## frameScheduler.py
+## Detecting the eyes on every frame of a webcam stream is mostly wasted: the head barely moves between frames
+## A FrameScheduler (one per video stream) decides which frames get a full detection, every interval frames,
+## and predicts the eye coordinates of the frames in between with a Kalman filter (constant velocity model).
+## The interval adapts to the load of the server, between minInterval (idle) and maxInterval (saturated),
+## and drops back to a detection on the next frame when the eyes move fast or when the last detection failed.
+## The detected coordinates go through the filter too, clients get steadier coordinates than the raw detections.
+##
+## Typical use, for every frame received at time t:
+##   if scheduler.detectNow(load):
+##       ... detect the eyes ...
+##       eyesX, eyesY = scheduler.update(t, eyesX, eyesY, faceBox, eyeBoxes)
+##   else:
+##       eyesX, eyesY, faceBox, eyeBoxes = scheduler.predict(t)
+##
+## Coordinates are image coordinates, -1 when there are no eyes. Boxes are [x, y, w, h] as returned by eyeDetector.imageBoxes
+
+####################################################################################################
+import cv2
+import numpy as np
+####################################################################################################
+
+
+####################################################################################################
+class EyeFilter(object):
+    ## Kalman filter of the point between the eyes, state: x, y, vx, vy (pixels, pixels per second)
+    ## Frames don't arrive at a fixed rate, the time step is the time elapsed since the previous frame
+
+    def __init__(self, measurementNoise=4.0, positionNoise=50.0, velocityNoise=5000.0):
+        ## measurementNoise: variance of the detected coordinates (pixels squared)
+        ## positionNoise, velocityNoise: how much position and velocity may change by themselves, per second
+        self.kalman = cv2.KalmanFilter(4, 2)
+        self.kalman.measurementMatrix = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], np.float32)
+        self.kalman.measurementNoiseCov = np.eye(2, dtype=np.float32) * measurementNoise
+        self.noise = np.diag([positionNoise, positionNoise, velocityNoise, velocityNoise]).astype(np.float32)
+        self.time = None ## Time of the current state, None until the first measurement
+
+    def reset(self):
+        self.time = None
+
+    def advance(self, t):
+        ## Moves the state forward to time t, returns the predicted x, y
+        dt = max(0.0, t - self.time)
+        self.kalman.transitionMatrix = np.array([[1, 0, dt, 0], [0, 1, 0, dt], [0, 0, 1, 0], [0, 0, 0, 1]], np.float32)
+        self.kalman.processNoiseCov = self.noise * max(dt, 1e-3)
+        state = self.kalman.predict()
+        self.time = t
+        return float(state[0]), float(state[1])
+
+    def correct(self, t, x, y):
+        ## New measurement at time t, returns the filtered x, y
+        if self.time is None:
+            ## First measurement: no velocity yet, unsure about it
+            self.kalman.statePost = np.array([[x], [y], [0], [0]], np.float32)
+            self.kalman.errorCovPost = np.diag([self.kalman.measurementNoiseCov[0,0]]*2 + [self.noise[2,2]]*2).astype(np.float32)
+            self.time = t
+            return float(x), float(y)
+        self.advance(t)
+        state = self.kalman.correct(np.array([[x], [y]], np.float32))
+        return float(state[0]), float(state[1])
+
+    def velocity(self):
+        ## Current speed estimate vx, vy in pixels per second
+        state = self.kalman.statePost
+        return float(state[2]), float(state[3])
+
+
+####################################################################################################
+class FrameScheduler(object):
+
+    def __init__(self, minInterval=1, maxInterval=8, motionThreshold=0.1, maxPrediction=1.0, loadSmoothing=0.2):
+        ## minInterval, maxInterval: frames between two detections when the server is idle, saturated
+        ## motionThreshold: detect on the next frame when the eyes move more than this fraction of the face width per frame
+        ## maxPrediction: seconds the coordinates are predicted without a successful detection, -1 after that
+        ## loadSmoothing: weight of the newest load in its moving average
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.motionThreshold = motionThreshold
+        self.maxPrediction = maxPrediction
+        self.loadSmoothing = loadSmoothing
+
+        self.filter = EyeFilter()
+        self.load = 0.0
+        self.interval = minInterval
+        self.framesSinceDetection = 0
+        self.lastDetection = None   ## Time of the last successful detection
+        self.lastFrame = None       ## Time of the previous frame
+        self.frameTime = None       ## Moving average of the time between frames
+        self.lastFilterX = self.lastFilterY = None ## Filtered coordinates when the boxes were detected
+        self.faceBox = None
+        self.eyeBoxes = []
+
+        ## Counters
+        self.detections = 0
+        self.predictions = 0
+
+    def tracking(self, t):
+        ## The eyes were found recently enough to be predicted at time t
+        return self.lastDetection is not None and t - self.lastDetection <= self.maxPrediction
+
+    def detectNow(self, load, t=None):
+        ## Whether the next frame needs a full detection
+        ## load: 0 when the server is idle, 1 or more when it is saturated
+        self.load += self.loadSmoothing * (load - self.load)
+        self.interval = int(round(self.minInterval + (self.maxInterval - self.minInterval) * min(1.0, max(0.0, self.load))))
+        self.framesSinceDetection += 1
+
+        if self.framesSinceDetection >= self.interval:
+            return True
+        if t is not None and not self.tracking(t):
+            return True
+        if self.lastDetection is None or self.faceBox is None or self.frameTime is None:
+            return True
+
+        ## Fast moves are badly predicted, and the prediction is far off when they stop
+        (vx, vy) = self.filter.velocity()
+        return np.hypot(vx, vy) * self.frameTime > self.motionThreshold * self.faceBox[2]
+
+    def frameReceived(self, t):
+        if self.lastFrame is not None:
+            elapsed = t - self.lastFrame
+            self.frameTime = elapsed if self.frameTime is None else self.frameTime + 0.2 * (elapsed - self.frameTime)
+        self.lastFrame = t
+
+    def update(self, t, eyesX, eyesY, faceBox, eyeBoxes):
+        ## Detection of the frame received at time t, returns the filtered eyesX, eyesY
+        self.frameReceived(t)
+        self.detections += 1
+        if eyesX < 0 or eyesY < 0:
+            ## Nothing found, detect again on the next frame. The reply of a detected frame says what was detected,
+            ## no eyes here: predicting them would send coordinates without boxes, flagged as not predicted
+            ## The filter keeps its state, the frames skipped later are still predicted from the previous eyes
+            self.framesSinceDetection = self.interval
+            return -1, -1
+
+        self.framesSinceDetection = 0
+        self.lastDetection = t
+        x, y = self.filter.correct(t, eyesX, eyesY)
+        self.lastFilterX, self.lastFilterY = x, y
+        self.faceBox = faceBox
+        self.eyeBoxes = eyeBoxes
+        return int(round(x)), int(round(y))
+
+    def predict(self, t, count=True):
+        ## Predicted eyesX, eyesY, faceBox, eyeBoxes of the frame received at time t
+        ## The boxes are the last detected ones, moved along with the eyes
+        if count:
+            self.frameReceived(t)
+            self.predictions += 1
+        if not self.tracking(t) or self.filter.time is None:
+            return -1, -1, None, []
+
+        x, y = self.filter.advance(t)
+        dx = int(round(x - self.lastFilterX))
+        dy = int(round(y - self.lastFilterY))
+        move = lambda box: [box[0] + dx, box[1] + dy, box[2], box[3]]
+        faceBox = move(self.faceBox) if self.faceBox is not None else None
+        return int(round(x)), int(round(y)), faceBox, [move(box) for box in self.eyeBoxes]
@@ -0,0 +1,311 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## loadGenerator.py
+## Puts realistic load on videoServer.py without real browsers
+## Opens N websocket connections to the server, each one sends jpeg frames at the given frame rate,
+## matches the replies to the frames they answer (frame ids) and measures the end to end latency.
+## Frames the server dropped (it only answers the newest frame of a client) are counted as dropped,
+## connections that fail are counted as failed.
+##
+## Inputs: same frame corpus options as benchmark.py (--frames DIR, --video FILE, --synthetic N)
+## Outputs: per connection and overall latency percentiles, achieved FPS, dropped and failed frames
+##          --output FILE writes them as json
+##
+## python loadGenerator.py --port 8090 --connections 50 --fps 10 --duration 30 --reply coords
+####################################################################################################
+
+####################################################################################################
+import os, sys, time, json, socket, struct, base64, threading
+from optparse import OptionParser
+import numpy as np
+
+import benchmark
+####################################################################################################
+
+
+####################################################################################################
+class WebSocketClient(object):
+    ## Just enough of a websocket client to talk to SimpleWebSocketServer: rfc 6455 handshake,
+    ## masked BINARY frames out, TEXT and BINARY messages in (no fragmentation)
+
+    def __init__(self, host, port, path, timeout=10):
+        self.sock = socket.create_connection((host, port), timeout)
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall('GET ' + path + ' HTTP/1.1\r\n'
+                          'Host: ' + host + ':' + str(port) + '\r\n'
+                          'Upgrade: websocket\r\n'
+                          'Connection: Upgrade\r\n'
+                          'Sec-WebSocket-Key: ' + key + '\r\n'
+                          'Sec-WebSocket-Version: 13\r\n\r\n')
+        response = ''
+        while '\r\n\r\n' not in response:
+            data = self.sock.recv(1024)
+            if not data:
+                raise Exception('connection closed during handshake')
+            response += data
+        if ' 101 ' not in response.split('\r\n')[0]:
+            raise Exception('handshake refused: ' + response.split('\r\n')[0])
+        ## Anything after the handshake is already websocket data
+        self.buffer = response[response.index('\r\n\r\n') + 4:]
+        self.sendLock = threading.Lock()
+
+    def sendFrame(self, data):
+        ## One masked BINARY message
+        length = len(data)
+        header = bytearray([0x82])
+        if length <= 125:
+            header.append(0x80 | length)
+        elif length <= 65535:
+            header.append(0x80 | 126)
+            header.extend(struct.pack('!H', length))
+        else:
+            header.append(0x80 | 127)
+            header.extend(struct.pack('!Q', length))
+
+        mask = os.urandom(4)
+        header.extend(mask)
+        padded = np.zeros(((length + 3) // 4) * 4, np.uint8)
+        padded[:length] = np.frombuffer(data, np.uint8)
+        masked = padded.view(np.uint32) ^ np.frombuffer(mask, np.uint32)[0]
+        with self.sendLock:
+            self.sock.sendall(str(header) + masked.tostring()[:length])
+
+    def read(self, count):
+        while len(self.buffer) < count:
+            data = self.sock.recv(65536)
+            if not data:
+                raise Exception('connection closed by the server')
+            self.buffer += data
+        data = self.buffer[:count]
+        self.buffer = self.buffer[count:]
+        return data
+
+    def recvMessage(self):
+        ## Returns opcode, payload of the next message from the server
+        (b1, b2) = struct.unpack('!BB', self.read(2))
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read(8))[0]
+        return b1 & 0x0F, self.read(length)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+####################################################################################################
+def replyFrameId(opcode, payload):
+    ## Frame id of a reply, in any of the reply modes of videoServer.py
+    if opcode == 0x2:
+        ## binary reply: uint8 version, uint8 flags, uint32 frame id...
+        return struct.unpack_from('!I', payload, 2)[0]
+    return json.loads(payload)['frameId']
+
+
+####################################################################################################
+class LoadConnection(object):
+    ## One simulated client: a thread sending frames at fps, a thread reading the replies
+
+    def __init__(self, number, options, frames):
+        self.number = number
+        self.options = options
+        self.frames = frames
+
+        self.sent = {}        ## frame id -> time sent, waiting for a reply
+        self.latencies = []   ## seconds, one per reply
+        self.framesSent = 0
+        self.replies = 0
+        self.dropped = 0      ## frames the server never answered because a newer one arrived
+        self.failed = 0       ## frames lost because the connection failed
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+        self.client = None
+
+    def run(self):
+        try:
+            path = '/?reply=' + self.options.reply
+            self.client = WebSocketClient(self.options.host, self.options.port, path)
+        except Exception as n:
+            self.error = 'connect: ' + str(n)
+            return
+
+        receiver = threading.Thread(target=self.receive)
+        receiver.daemon = True
+        receiver.start()
+
+        self.started = time.time()
+        period = 1.0 / self.options.fps
+        end = self.started + self.options.duration
+        try:
+            while self.error is None:
+                now = time.time()
+                due = self.started + self.framesSent * period
+                if due >= end:
+                    break
+                if due > now:
+                    time.sleep(due - now)
+
+                frame = self.frames[(self.number + self.framesSent) % len(self.frames)]
+                with self.lock:
+                    self.framesSent += 1
+                    self.sent[self.framesSent] = time.time()
+                self.client.sendFrame(frame)
+
+        except Exception as n:
+            self.error = 'send: ' + str(n)
+
+        ## Give the last replies some time to arrive
+        deadline = time.time() + self.options.linger
+        while self.sent and self.error is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.finished = time.time()
+        self.client.close()
+        receiver.join(1)
+        with self.lock:
+            ## Whatever did not get a reply by now
+            if self.error is not None:
+                self.failed += len(self.sent)
+            else:
+                self.dropped += len(self.sent)
+            self.sent.clear()
+
+    def receive(self):
+        try:
+            while True:
+                opcode, payload = self.client.recvMessage()
+                received = time.time()
+                frameId = replyFrameId(opcode, payload)
+                with self.lock:
+                    sentTime = self.sent.pop(frameId, None)
+                    if sentTime is None:
+                        continue
+                    self.replies += 1
+                    self.latencies.append(received - sentTime)
+                    ## Frames sent before this one and still waiting were dropped by the server
+                    for older in [i for i in self.sent if i < frameId]:
+                        del self.sent[older]
+                        self.dropped += 1
+
+        except Exception as n:
+            if self.finished is None:
+                self.error = 'receive: ' + str(n)
+
+    def report(self):
+        seconds = (self.finished or time.time()) - (self.started or time.time())
+        report = {'connection': self.number, 'sent': self.framesSent, 'replies': self.replies,
+                  'dropped': self.dropped, 'failed': self.failed, 'error': self.error,
+                  'fps': self.replies / seconds if seconds > 0 else 0.0}
+        if self.latencies:
+            report['latency'] = benchmark.summarize(self.latencies)
+        return report
+
+
+####################################################################################################
+def printReport(report):
+    line = '%(sent)6d sent %(replies)6d replies %(dropped)6d dropped %(failed)6d failed %(fps)7.1f fps' % report
+    if 'latency' in report:
+        line += '  p50 %(p50)8.1f  p95 %(p95)8.1f  p99 %(p99)8.1f ms' % report['latency']
+    if report.get('error'):
+        line += '  ' + report['error']
+    return line
+
+
+##################################################################################################
+if __name__ == "__main__":
+
+    parser = OptionParser(usage="usage: %prog [options]", version="%prog 1.0")
+    parser.add_option("--host", default='localhost', type='string', action="store", dest="host", help="server host (localhost)")
+    parser.add_option("--port", default=8090, type='int', action="store", dest="port", help="server port (8090)")
+    parser.add_option("--connections", default=10, type='int', action="store", dest="connections", help="simultaneous connections (10)")
+    parser.add_option("--fps", default=10.0, type='float', action="store", dest="fps", help="frames per second sent by each connection (10)")
+    parser.add_option("--duration", default=10.0, type='float', action="store", dest="duration", help="seconds of sending (10)")
+    parser.add_option("--rampup", default=1.0, type='float', action="store", dest="rampup", help="seconds over which the connections are opened (1)")
+    parser.add_option("--linger", default=2.0, type='float', action="store", dest="linger", help="seconds to wait for the last replies (2)")
+    parser.add_option("--reply", default='coords', type='string', action="store", dest="reply", help="reply mode asked to the server: coords, frame, binary (coords)")
+    parser.add_option("--frames", default=None, type='string', action="store", dest="frames", help="directory of jpeg/png frames")
+    parser.add_option("--video", default=None, type='string', action="store", dest="video", help="video file")
+    parser.add_option("--synthetic", default=0, type='int', action="store", dest="synthetic", help="number of synthetic frames (default if nothing else is given: 100)")
+    parser.add_option("--size", default='320x240', type='string', action="store", dest="size", help="synthetic frame size (320x240)")
+    parser.add_option("--quality", default=20, type='int', action="store", dest="quality", help="jpeg quality of video and synthetic frames (20)")
+    parser.add_option("--perConnection", default=False, action="store_true", dest="perConnection", help="print every connection")
+    parser.add_option("--output", default=None, type='string', action="store", dest="output", help="write the results to this json file")
+    (options, args) = parser.parse_args()
+
+    if options.frames:
+        frames = benchmark.loadFrames(options.frames)
+    elif options.video:
+        frames = benchmark.loadVideo(options.video, 300, options.quality)
+    else:
+        (width, height) = [int(value) for value in options.size.split('x')]
+        frames = benchmark.syntheticFrames(options.synthetic or 100, width, height, options.quality)
+    frames = [np.asarray(frame).tostring() for frame in frames]
+
+    if not frames:
+        print 'ERROR: No frames to send'
+        sys.exit(1)
+
+    print 'Load: %d connections x %.1f fps for %.1f s, reply mode %s, %d frames of %d bytes on average' % (
+        options.connections, options.fps, options.duration, options.reply, len(frames), sum(len(f) for f in frames) / len(frames))
+    print '*****************************************************************'
+
+    connections = [LoadConnection(i, options, frames) for i in range(options.connections)]
+    threads = []
+    for connection in connections:
+        thread = threading.Thread(target=connection.run)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        time.sleep(options.rampup / max(1, options.connections))
+    for thread in threads:
+        thread.join()
+
+    reports = [connection.report() for connection in connections]
+    if options.perConnection:
+        for report in reports:
+            print '%5d ' % report['connection'] + printReport(report)
+
+    latencies = sum((connection.latencies for connection in connections), [])
+    total = {'sent': sum(r['sent'] for r in reports), 'replies': sum(r['replies'] for r in reports),
+             'dropped': sum(r['dropped'] for r in reports), 'failed': sum(r['failed'] for r in reports),
+             'fps': sum(r['fps'] for r in reports),
+             'errors': len([r for r in reports if r['error']])}
+    if latencies:
+        total['latency'] = benchmark.summarize(latencies)
+    print 'TOTAL ' + printReport(total) + '  %d connections with errors' % total['errors']
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': options.__dict__, 'total': total, 'connections': reports}, f, indent=1, sort_keys=True)
+        print 'Results written to ' + options.output
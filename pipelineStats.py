@@ -0,0 +1,157 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## pipelineStats.py
+## Low overhead timing of the frame processing pipeline (decode, face, eyes, draw, encode, send...)
+## PipelineStats(parent) keeps a latency histogram per stage and a few counters
+## Stats of a connection can have the stats of the whole process as parent, everything recorded 
+## in the connection stats is then recorded in the process stats too.
+## 
+## Typical use:
+##   start = time.time()
+##   ...
+##   stats.record('decode', time.time() - start)
+##   stats.count('faces')
+##
+## snapshot() returns everything as a dict, dump() as a line of text to log.
+## dumpEvery(stats, seconds) logs the dump periodically from a background thread
+
+####################################################################################################
+import time
+import bisect
+import logging
+import threading
+####################################################################################################
+
+
+####################################################################################################
+## Histogram buckets: 10 per decade from 10 microseconds to 100 seconds (~25% resolution)
+## Anything slower goes into the last bucket
+bucketBounds = [1e-5 * 10**(i/10.0) for i in range(71)]
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(bucketBounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(bucketBounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        ## Upper bound of the bucket holding the p-th percentile (0 < p <= 100), in seconds
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                if i >= len(bucketBounds):
+                    return self.max
+                return min(bucketBounds[i], self.max)
+        return self.max
+
+    def snapshot(self):
+        ## Everything in milliseconds
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': 1000.0 * self.total / self.count,
+                'min': 1000.0 * self.min,
+                'p50': 1000.0 * self.percentile(50),
+                'p95': 1000.0 * self.percentile(95),
+                'p99': 1000.0 * self.percentile(99),
+                'max': 1000.0 * self.max}
+
+
+####################################################################################################
+class PipelineStats(object):
+
+    def __init__(self, parent=None):
+        ## parent: PipelineStats that also gets everything recorded here (process wide stats...)
+        self.parent = parent
+        self.stages = {}
+        self.counters = {}
+        self.started = time.time()
+        ## Stages are recorded from the worker threads too
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        ## Time spent in stage, in seconds
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = LatencyHistogram()
+            histogram.record(seconds)
+        if self.parent is not None:
+            self.parent.record(stage, seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        if self.parent is not None:
+            self.parent.count(name, n)
+
+    def snapshot(self):
+        ## {'seconds': time since created, 'stages': {stage: histogram snapshot}, 'counters': {name: value}}
+        with self.lock:
+            stages = dict((stage, histogram.snapshot()) for (stage, histogram) in self.stages.items())
+            counters = dict(self.counters)
+        return {'seconds': time.time() - self.started, 'stages': stages, 'counters': counters}
+
+    def dump(self):
+        ## One line of text: counters, then count/p50/p95/p99 in milliseconds for every stage
+        snapshot = self.snapshot()
+        text = ' '.join('%s=%d' % (name, value) for (name, value) in sorted(snapshot['counters'].items()))
+        for (stage, s) in sorted(snapshot['stages'].items()):
+            if s['count'] > 0:
+                text += ' | %s n=%d p50=%.2f p95=%.2f p99=%.2f ms' % (stage, s['count'], s['p50'], s['p95'], s['p99'])
+        return text
+
+
+####################################################################################################
+def dumpEvery(stats, interval):
+    ## Logs stats.dump() every interval seconds from a daemon thread
+    def run():
+        while True:
+            time.sleep(interval)
+            logging.info('STATS ' + stats.dump())
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
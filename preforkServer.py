@@ -0,0 +1,178 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## preforkServer.py
+## One server process only ever uses one core for the Python side of the work (websocket frames, json...)
+## PreforkServer runs the same server in several processes, all accepting connections on the same port:
+## the master process prepares everything that can be shared (Haar cascades loaded by eyeDetector on import,
+## the listening socket...) and forks the worker processes, that do all the serving.
+## Forked workers share the memory of the master until they write to it (copy on write), the cascades
+## loaded by the master are not duplicated (the detection threads of --workers still load their own).
+##
+## The workers either all accept on the socket the master listens on and hands over by forking, or each
+## listen on their own SO_REUSEPORT socket (reusePort, Linux 3.9+), the kernel then spreads the connections evenly.
+## The master restarts the workers that die, and stops them all when it gets SIGINT or SIGTERM.
+## The workers exit when the master is gone.
+##
+## Typical use:
+##   def serve(serversocket):
+##       server = SimpleWebSocketServer(host, port, VideoServer, serversocket=serversocket)
+##       server.serveforever()
+##   PreforkServer(4, serve, host, port).run()
+
+####################################################################################################
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+import threading
+from SimpleWebSocketServer import listenSocket
+####################################################################################################
+
+
+####################################################################################################
+class PreforkServer(object):
+
+    def __init__(self, processes, serve, host, port, reusePort=False, restartDelay=1.0):
+        ## processes: number of worker processes
+        ## serve(serversocket): runs the server of a worker process until it is closed, on the listening socket given
+        ## reusePort: every worker listens on its own SO_REUSEPORT socket instead of the one of the master
+        ## restartDelay: a worker dying sooner than this after being started is restarted after this delay
+        self.processes = processes
+        self.serve = serve
+        self.host = host
+        self.port = port
+        self.reusePort = reusePort
+        self.restartDelay = restartDelay
+
+        self.children = {} ## pid -> (worker number, start time)
+        self.running = False
+        self.restarts = 0
+
+        ## Listening before forking: every worker inherits the socket
+        ## It also makes sure the port is available before any worker is started
+        self.serversocket = None
+        if not reusePort:
+            self.serversocket = listenSocket(host, port)
+
+    def run(self):
+        ## Starts the workers and supervises them until SIGINT or SIGTERM, then stops them
+        self.running = True
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for number in range(self.processes):
+            self.spawn(number)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise e
+
+            if pid not in self.children:
+                continue
+            (number, started) = self.children.pop(pid)
+            if not self.running:
+                continue
+
+            logging.warning('prefork: worker %d (pid %d) %s, restarting it', number, pid, describeStatus(status))
+            self.restarts += 1
+            ## A worker that dies right away would die again, don't fork in a tight loop
+            if time.time() - started < self.restartDelay:
+                time.sleep(self.restartDelay)
+            if self.running:
+                self.spawn(number)
+
+        if self.serversocket is not None:
+            self.serversocket.close()
+        logging.info('prefork: all workers stopped')
+
+    def stop(self, signum=None, frame=None):
+        ## Stops the workers, run returns once they are all gone
+        self.running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            self.runWorker(number)
+        self.children[pid] = (number, time.time())
+        logging.info('prefork: worker %d started, pid %d', number, pid)
+
+    def runWorker(self, number):
+        ## In the forked process, never returns
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            watchParent(os.getppid())
+
+            serversocket = self.serversocket
+            if self.reusePort:
+                serversocket = listenSocket(self.host, self.port, reusePort=True)
+            self.serve(serversocket)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            logging.exception('prefork: worker %d failed', number)
+            status = 1
+        finally:
+            ## Never go back to the code of the master
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+
+####################################################################################################
+def watchParent(parentPid, interval=1.0):
+    ## Exits the process when its parent is gone (killed without the time to stop its workers...)
+    def watch():
+        while os.getppid() == parentPid:
+            time.sleep(interval)
+        logging.warning('prefork: master process gone, worker exiting')
+        os._exit(1)
+
+    thread = threading.Thread(target=watch, name='watchParent')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def describeStatus(status):
+    ## os.wait status as text
+    if os.WIFSIGNALED(status):
+        return 'was killed by signal ' + str(os.WTERMSIG(status))
+    return 'exited with status ' + str(os.WEXITSTATUS(status))
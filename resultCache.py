@@ -0,0 +1,111 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## resultCache.py
+## Some clients send the very same jpeg again and again (stalled camera, background tab, retries...)
+## A ResultCache keeps the results of the last frames, keyed on a hash of the bytes received:
+## a duplicate frame then costs a hash and a dictionary lookup instead of decoding, detecting and encoding
+## The least recently used results are evicted first, once the cache holds more than maxBytes
+##
+## Typical use:
+##   key = cache.key(payload, ...)      # anything else the result depends on goes in the key too
+##   result = cache.get(key)
+##   if result is None:
+##       result = ...
+##       cache.put(key, result, size)
+##
+## Thread safe, the server workers share one cache. snapshot() and dump() give the hit rate
+
+####################################################################################################
+import hashlib
+import threading
+from collections import OrderedDict
+####################################################################################################
+
+
+####################################################################################################
+class ResultCache(object):
+
+    ## Bookkeeping of an entry (key, dict slot, tuple...), counted on top of the size given to put
+    entryOverhead = 256
+
+    def __init__(self, maxBytes=32*1024*1024):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict() ## key -> (result, size), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, payload, *context):
+        ## Hash of the payload (str, bytearray, memoryview...), plus whatever else makes the result different (reply mode, profile...)
+        return (hashlib.md5(payload).digest(), len(payload)) + context
+
+    def get(self, key):
+        ## Cached result of key, None if there is none
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            ## Most recently used now
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result, size=0):
+        ## size: bytes held by result (encoded image...), the cache evicts to stay under maxBytes
+        size += self.entryOverhead
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (result, size)
+            self.size += size
+            while self.size > self.maxBytes:
+                (oldKey, (oldResult, oldSize)) = self.entries.popitem(last=False)
+                self.size -= oldSize
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'hitRate': float(self.hits) / lookups if lookups else 0.0}
+
+    def dump(self):
+        ## One line of text, for the logs
+        return 'entries=%(entries)d bytes=%(bytes)d hits=%(hits)d misses=%(misses)d evictions=%(evictions)d hitRate=%(hitRate).3f' % self.snapshot()
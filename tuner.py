@@ -0,0 +1,231 @@
+## MIT LICENSE
+#Copyright (c) 2014 Hugo Arguinariz.
+#http://www.hugoargui.com
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+
+####################################################################################################
+
+## tuner.py
+## Finds the fastest detector settings that still find the eyes, instead of trial and error
+## Inputs: --frames DIR      jpeg/png frames
+##         --labels FILE     json, the expected eye coordinates of every frame: {"f000.jpg": [eyesX, eyesY], "f001.jpg": null, ...}
+##                           null means there are no eyes to find in that frame
+## Outputs: detection rate and time per frame of every combination of --scales, --faceScaleFactors,
+##          --faceMinNeighbors, --eyesScaleFactors, --eyesMinNeighbors and --eyesSearches,
+##          the Pareto frontier (no other setting is both faster and more accurate),
+##          and the fastest setting of the frontier reaching --target, as a DetectorProfile ready for eyeDetector.profiles
+##
+## A frame is detected correctly when the eyes are found within --tolerance (fraction of the frame width)
+## of the label, or when nothing is found in a frame labeled null
+##
+## Labeling frames by hand is tedious, --makeLabels FILE writes the labels found by the --profile settings instead
+## Check them (and fix the wrong ones) before tuning against them
+##
+## Run from the directory holding haarCascadesXML, e.g.
+## python tuner.py --frames myFrames/ --makeLabels labels.json
+## python tuner.py --frames myFrames/ --labels labels.json --target 0.95 --output tuning.json
+####################################################################################################
+
+####################################################################################################
+import os, sys, time, json, itertools
+from optparse import OptionParser
+import cv2
+import numpy as np
+
+import eyeDetector
+from benchmark import summarize, floats, ints
+####################################################################################################
+
+
+####################################################################################################
+## Labeled corpus: (name, byte-encoded frame, frame width, expected eyesX, eyesY or None)
+
+def frameNames(directory):
+    ## Every jpeg and png of directory, in name order
+    return [name for name in sorted(os.listdir(directory)) if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png')]
+
+def readFrame(directory, name):
+    with open(os.path.join(directory, name), 'rb') as f:
+        return np.fromstring(f.read(), dtype=np.uint8)
+
+def loadLabeledFrames(directory, labelsFile):
+    ## Frames of directory that have a label, frames without one are skipped (with a warning)
+    with open(labelsFile) as f:
+        labels = json.load(f)
+
+    corpus = []
+    for name in frameNames(directory):
+        if name not in labels:
+            print 'WARNING: No label for ' + name + ', skipped'
+            continue
+        frame = readFrame(directory, name)
+        gray = cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            print 'WARNING: Could not decode ' + name + ', skipped'
+            continue
+        expected = tuple(labels[name]) if labels[name] is not None else None
+        corpus.append((name, frame, gray.shape[1], expected))
+    return corpus
+
+def makeLabels(directory, profile, labelsFile):
+    ## Labels of every frame of directory as found by profile, to be checked by hand
+    labels = {}
+    for name in frameNames(directory):
+        gray, eyesX, eyesY = eyeDetector.detectEyesFast(readFrame(directory, name), profile=profile)
+        labels[name] = [eyesX, eyesY] if eyesX >= 0 else None
+    with open(labelsFile, 'w') as f:
+        json.dump(labels, f, indent=1, sort_keys=True)
+    found = len([label for label in labels.values() if label is not None])
+    print 'Labels of ' + str(len(labels)) + ' frames (eyes found in ' + str(found) + ') written to ' + labelsFile
+
+
+####################################################################################################
+## Scoring
+
+## Parameters swept by the tuner, the others keep the value of --profile
+tunedParameters = ('scale', 'faceScaleFactor', 'faceMinNeighbors', 'eyesScaleFactor', 'eyesMinNeighbors', 'eyesSearch')
+
+def isCorrect(expected, eyesX, eyesY, maxDistance):
+    if expected is None:
+        return eyesX < 0
+    if eyesX < 0:
+        return False
+    return np.hypot(eyesX - expected[0], eyesY - expected[1]) <= maxDistance
+
+def scoreSetting(corpus, profile, tolerance, repeat):
+    ## Detects the eyes of every frame with profile, each frame on its own (no EyeTracker)
+    ## Returns the detection rate and the time per frame of the last run (the first ones warm up caches)
+    for run in range(repeat):
+        samples = []
+        correct = 0
+        missed = 0
+        falsePositives = 0
+        for (name, frame, width, expected) in corpus:
+            start = time.time()
+            gray, eyesX, eyesY = eyeDetector.detectEyesFast(frame, profile=profile)
+            samples.append(time.time() - start)
+
+            if isCorrect(expected, eyesX, eyesY, tolerance*width):
+                correct += 1
+            elif expected is None:
+                falsePositives += 1
+            else:
+                missed += 1
+
+    return {'parameters': profile.parameters(), 'detectionRate': float(correct) / len(corpus),
+            'missed': missed, 'falsePositives': falsePositives, 'time': summarize(samples)}
+
+
+####################################################################################################
+## Pareto frontier: the settings no other setting beats on both speed and detection rate
+
+def paretoFrontier(results):
+    ## Fastest first, a setting is on the frontier if it detects better than every faster one
+    frontier = []
+    for result in sorted(results, key=lambda r: (r['time']['mean'], -r['detectionRate'])):
+        if not frontier or result['detectionRate'] > frontier[-1]['detectionRate']:
+            frontier.append(result)
+    return frontier
+
+def recommend(frontier, target):
+    ## Fastest setting reaching the target detection rate, the most accurate one if none does
+    for result in frontier:
+        if result['detectionRate'] >= target:
+            return result
+    return frontier[-1]
+
+def printResult(result, marker=' '):
+    print marker, 'rate %5.1f%%  missed %3d  false %3d  mean %8.2f  p95 %8.2f ms | %s' % (
+          100.0 * result['detectionRate'], result['missed'], result['falsePositives'],
+          result['time']['mean'], result['time']['p95'],
+          ', '.join('%s=%s' % (name, result['parameters'][name]) for name in tunedParameters))
+
+
+
+##################################################################################################
+if __name__ == "__main__":
+
+    parser = OptionParser(usage="usage: %prog [options]", version="%prog 1.0")
+    parser.add_option("--frames", default=None, type='string', action="store", dest="frames", help="directory of jpeg/png frames")
+    parser.add_option("--labels", default=None, type='string', action="store", dest="labels", help="json file of the expected eye coordinates of the frames")
+    parser.add_option("--makeLabels", default=None, type='string', action="store", dest="makeLabels", help="write the labels found with --profile to this json file, and stop")
+    parser.add_option("--profile", default='default', type='choice', choices=sorted(eyeDetector.profiles), action="store", dest="profile", help="detector profile the settings below start from: " + ', '.join(sorted(eyeDetector.profiles)) + ' (default)')
+    parser.add_option("--scales", default='0.5,0.6,0.7,0.85,1.0', type='string', action="store", dest="scales", help="comma separated scales to try (0.5,0.6,0.7,0.85,1.0)")
+    parser.add_option("--faceScaleFactors", default='1.05,1.1,1.2', type='string', action="store", dest="faceScaleFactors", help="comma separated face scaleFactors (1.05,1.1,1.2)")
+    parser.add_option("--faceMinNeighbors", default='4,6', type='string', action="store", dest="faceMinNeighbors", help="comma separated face minNeighbors (4,6)")
+    parser.add_option("--eyesScaleFactors", default='1.01,1.02,1.05,1.1', type='string', action="store", dest="eyesScaleFactors", help="comma separated eyes scaleFactors (1.01,1.02,1.05,1.1)")
+    parser.add_option("--eyesMinNeighbors", default='3', type='string', action="store", dest="eyesMinNeighbors", help="comma separated eyes minNeighbors (3)")
+    parser.add_option("--eyesSearches", default='full,coarse', type='string', action="store", dest="eyesSearches", help="comma separated eyes searches, full and/or coarse (full,coarse)")
+    parser.add_option("--tolerance", default=0.05, type='float', action="store", dest="tolerance", help="maximum distance to the label, fraction of the frame width (0.05)")
+    parser.add_option("--target", default=0.9, type='float', action="store", dest="target", help="detection rate the recommended setting must reach (0.9)")
+    parser.add_option("--repeat", default=1, type='int', action="store", dest="repeat", help="runs over the corpus per setting, only the last one is measured (1)")
+    parser.add_option("--output", default=None, type='string', action="store", dest="output", help="write every result, the frontier and the recommendation to this json file")
+    (options, args) = parser.parse_args()
+
+    if not options.frames:
+        parser.error('--frames is required')
+    baseProfile = eyeDetector.profiles[options.profile]
+
+    if options.makeLabels:
+        makeLabels(options.frames, baseProfile, options.makeLabels)
+        sys.exit(0)
+
+    if not options.labels:
+        parser.error('--labels is required (make one with --makeLabels)')
+    corpus = loadLabeledFrames(options.frames, options.labels)
+    if not corpus:
+        print 'ERROR: No labeled frames in ' + options.frames
+        sys.exit(1)
+
+    grid = list(itertools.product(floats(options.scales), floats(options.faceScaleFactors), ints(options.faceMinNeighbors),
+                                  floats(options.eyesScaleFactors), ints(options.eyesMinNeighbors), options.eyesSearches.split(',')))
+    print 'Tuning ' + str(len(grid)) + ' settings over ' + str(len(corpus)) + ' labeled frames, OpenCV ' + cv2.__version__
+    print '*****************************************************************'
+
+    results = []
+    for setting in grid:
+        profile = baseProfile.copy(**dict(zip(tunedParameters, setting)))
+        result = scoreSetting(corpus, profile, options.tolerance, max(1, options.repeat))
+        printResult(result)
+        results.append(result)
+
+    frontier = paretoFrontier(results)
+    best = recommend(frontier, options.target)
+
+    print '*****************************************************************'
+    print 'Pareto frontier, fastest first (* recommended):'
+    for result in frontier:
+        printResult(result, '*' if result is best else ' ')
+    if best['detectionRate'] < options.target:
+        print 'WARNING: No setting reaches the target detection rate of ' + str(options.target) + ', recommending the most accurate one'
+    print 'Recommended profile:'
+    print '    ' + repr(baseProfile.copy('tuned', **dict((name, best['parameters'][name]) for name in tunedParameters)))
+
+    if options.output:
+        report = {'frames': len(corpus), 'labels': options.labels, 'profile': options.profile,
+                  'tolerance': options.tolerance, 'target': options.target, 'opencv': cv2.__version__,
+                  'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'results': results, 'frontier': frontier, 'recommended': best}
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print 'Results written to ' + options.output
@@ -57,13 +57,37 @@
 ## This last step is optional, it may be enough to send only the eye coordinate variables (X, Y)
 ## This coordinates could be used on the client side to draw the exact same rectangles
 
+## With --workers N the 3 steps run on N threads (OpenCV releases the GIL), so one slow frame does not stall 
+## the other clients. The replies are still sent from the server thread.
+## A client sending frames faster than we process them only gets replies to its newest frames, the others are dropped
+
 ## If the image is not going to be sent, step C should be removed in order to improve performace.
+## Clients can do that by connecting with ws://server:8090/?reply=coords
+## Only the eye and face coordinates are sent back then, the image is never drawn nor encoded
+## ws://server:8090/?reply=binary sends the image as raw jpeg in a BINARY message, without base64 and json
+
+## The detection parameters (scale, Haar sizes, jpeg quality...) come from an eyeDetector profile, per connection
+## Clients pick one with ws://server:8090/?profile=hd, or ?profile=auto to let the server choose from the
+## resolution of their first frame. Combine both options with &: ?reply=coords&profile=low
+## ?track=eyes follows the eyes from frame to frame by template matching, the Haar cascades then only run
+## now and then (see eyeDetector.EyeTracker). ?track=face (default) runs the eye cascade on every frame
+## ?schedule=adaptive only detects the eyes every few frames, more of them the busier the server is,
+## the coordinates of the frames in between are predicted (see frameScheduler). The replies then tell
+## whether the coordinates were predicted, and all coordinates are smoothed
+## Frames that did not change since the last detection (the user sits still) are not detected again,
+## unless the client connects with ?gate=off
+## Byte for byte duplicates of recent frames (stalled camera, retries...) get their reply from a cache (--cache)
+## --backend asyncio serves the connections on an asyncio event loop instead (see asyncWebSocketServer),
+## with the detection running on --workers executor threads
+## --detectors N detects the frames in N processes instead (see detectorPool), the frames and the replies
+## go through shared memory
 ####################################################################################################
 
 
 ####################################################################################################
-import signal, sys, ssl, logging
+import signal, sys, ssl, logging, struct
 import time
+import urlparse
 from SimpleWebSocketServer import WebSocket, SimpleWebSocketServer, SimpleSSLWebSocketServer
 from optparse import OptionParser
 import cv2
@@ -72,6 +96,12 @@ import base64
 
 ## Import custom packages
 import eyeDetector
+import pipelineStats
+import frameScheduler
+import resultCache
+import preforkServer
+import asyncWebSocketServer
+import detectorPool
 import clientAnimation
 
 try: 
@@ -84,6 +114,79 @@ logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 ##################################################################################################
 class VideoServer(WebSocket):
 
+    ## Reply modes a client can ask for when connecting, in the websocket url: ws://server:8090/?reply=coords
+    ## frame:  (default) eye coordinates + the image with rectangles around the eyes, base64 jpeg
+    ## coords: eye and face coordinates only. Nothing is drawn nor encoded, the client draws its own overlays
+    ## binary: BINARY websocket messages, a small fixed header followed by the raw jpeg image (no base64, no json)
+    replyModes = ('frame', 'coords', 'binary')
+
+    ## What the eye tracker of a connection follows between frames, ws://server:8090/?track=eyes
+    trackModes = ('face', 'eyes')
+
+    ## Which frames get a detection, ws://server:8090/?schedule=adaptive
+    ## every: (default) all of them. adaptive: a FrameScheduler decides, the others get predicted coordinates
+    scheduleModes = ('every', 'adaptive')
+
+    ## Motion gate of the eye tracker, ws://server:8090/?gate=off
+    ## on: (default) frames that did not change since the last detection get the same result, nothing is detected
+    gateModes = ('on', 'off')
+    defaultSchedule = 'every' ## --schedule
+
+    ## Header of the binary replies, big endian:
+    ## uint8 version, uint8 flags (1: a jpeg image follows the header, 2: predicted coordinates), uint32 frame id,
+    ## int16 eyesX, eyesY, face x, y, w, h, first eye x, y, w, h, second eye x, y, w, h (-1 when not found)
+    binaryHeader = struct.Struct('!BBI14h')
+    binaryVersion = 1
+
+    ## Detector profile of the clients that don't ask for one (--profile), see eyeDetector.profiles
+    ## auto: chosen from the resolution of the first frame of the client
+    defaultProfile = 'default'
+
+    ## Stage timings and counters of the whole process, each connection also has its own (self.stats)
+    ## Stages: decode, prepare, face, eyes, draw, encode, base64, json, send, frame (processing of one frame, 
+    ## decode to json) and latency (frame received to reply queued for sending, waiting included)
+    ## With --detectors: detect (prepare, face and eyes in the detector process) instead of prepare, face and eyes
+    processStats = pipelineStats.PipelineStats()
+
+    ## Frame counters of the whole process, each connection also has its own
+    totalFramesReceived = 0
+    totalFramesProcessed = 0
+    totalFramesDropped = 0
+
+    ## Connections with a frame being processed or waiting for it, the load of the server (see serverLoad)
+    busyConnections = 0
+
+    ## Results of recent frames of all the connections, keyed on a hash of the frame, None to disable (--cache)
+    ## cacheImages: the encoded images are cached too, not just the coordinates (--cacheImages)
+    cache = resultCache.ResultCache()
+    cacheImages = True
+
+    ## detectorPool.DetectorPool running the detection in other processes (--detectors), None to detect in this one
+    detectors = None
+    ## Reply modes as detector operations
+    detectorOperations = {'coords': detectorPool.COORDS, 'binary': detectorPool.JPEG, 'frame': detectorPool.BASE64}
+
+    ##############################################################################################
+    def __init__(self, server, sock, address):
+        WebSocket.__init__(self, server, sock, address)
+        self.pendingFrame = None ## Newest frame received and not processed yet
+        self.pendingBuffer = None ## Receive buffer holding it (see WebSocket.keepData)
+        self.frameBuffer = None  ## Receive buffer holding the frame being processed
+        self.busy = False        ## A frame of this client is being processed (or about to be)
+        self.closed = False
+
+        self.framesReceived = 0
+        self.framesProcessed = 0
+        self.framesDropped = 0   ## Frames replaced by a newer one before being processed
+
+        self.scheduler = None    ## ?schedule=adaptive: decides which frames are detected
+        self.predicted = False   ## The coordinates of the frame being processed are predicted, not detected
+        self.cacheKey = None     ## Key of the frame being processed in the result cache
+        self.detection = None    ## eyesX, eyesY, faceBox, eyeBoxes detected in it, before the scheduler smooths them
+        self.detectorId = None   ## Number of the connection in the detector pool (--detectors)
+
+        self.stats = pipelineStats.PipelineStats(parent=VideoServer.processStats)
+
     ##############################################################################################
     def handleMessage(self):
         ## STEP A
@@ -91,9 +194,53 @@ class VideoServer(WebSocket):
         if self.data is None:
             self.data = ''
 
-        decImg = None  ## Image after being decoded
-        procImg = None ## Image with rectangles around the eyes
-        encImg = None  ## Image encoded in a format suitable to be sent over websocket
+        self.framesReceived += 1
+        VideoServer.totalFramesReceived += 1
+
+        ## Clients send frames at their own pace, whether we keep up or not
+        ## For eye tracking a fresh answer is worth more than a complete one:
+        ## only the newest frame waits to be processed, older ones are dropped
+        if self.pendingFrame is not None:
+            self.framesDropped += 1
+            VideoServer.totalFramesDropped += 1
+            self.stats.count('dropped')
+            self.releaseData(self.pendingBuffer)
+
+        ## self.data is a view of the receive buffer, not a copy: keep the buffer along with the frame
+        ## until it is processed, the connection reads the next frames into another one
+        ## Replies carry the number of the frame they answer, so clients can tell which frames were dropped
+        self.pendingBuffer = self.keepData()
+        self.pendingFrame = self.data
+        self.pendingFrameId = self.framesReceived
+        self.pendingFrameTime = time.time()
+
+        ## Frames of one client are processed one at a time, the eye tracker follows them one after the other
+        ## Frames of different clients are processed in parallel when the server has workers
+        if not self.busy:
+            self.setBusy(True)
+            ## Let the server finish reading first, if more frames of this client are already there only the newest is processed
+            self.server.callFromThread(self.processPendingFrame)
+
+    ##############################################################################################
+    def processPendingFrame(self):
+        frame = self.pendingFrame
+        self.frameBuffer = self.pendingBuffer
+        self.pendingFrame = None
+        self.pendingBuffer = None
+        if self.closed or frame is None:
+            self.setBusy(False)
+            return
+        if VideoServer.detectors is not None:
+            self.submitFrame(frame, self.pendingFrameId, self.pendingFrameTime)
+            return
+        self.server.runInWorker(self.processFrame, (frame, self.pendingFrameId, self.pendingFrameTime), self.frameDone)
+
+    ##############################################################################################
+    def processFrame(self, frame, frameId, received):
+        ## Runs on a worker thread when the server has workers, only touches this client's data
+        ## Returns the message to send back and the time the frame was received, message is None if something went wrong
+        message = None
+        start = time.time()
 
         # #################################################
         # Try processing the frame
@@ -102,69 +249,465 @@ class VideoServer(WebSocket):
         #########################################
         # Decode image
         # The image should have been received from the client in binary form
-            img = str(self.data)
-                img = np.fromstring(img, dtype=np.uint8)
-                decImg = eyeDetector.decodeImage(img)
+            ## A view of the receive buffer, decodeImage reads the bytes right where recv_into wrote them
+            img = np.asarray(frame)
+            if self.profile is None:
+                self.chooseProfile(img)
+
+            cached = self.lookupCache(frame)
+            if cached is not None:
+                return self.cachedReply(img, frameId, cached, received), received
+
+            if self.replyMode == 'coords':
+                message = self.coordsReply(img, frameId, received)
+            elif self.replyMode == 'binary':
+                message = self.binaryReply(img, frameId, received)
+            else:
+                message = self.frameReply(img, frameId, received)
 
-            if (decImg == None):
-                print self.address, 'ERROR: Could not decode image. System time: '+ str(time.clock())
+        except Exception as n:
+            print 'OpenCV catch fail' + str(n)
 
-            if ( decImg != None):
-                ## STEP B
-                ## Nothing wrong, detect eyes in the image
-                procImg, eyesX, eyesY =  eyeDetector.detectEyes(decImg)
+        self.recordSince('frame', start)
+        return message, received
 
+    ##############################################################################################
+    def frameDone(self, result):
+        ## Back on the server thread with the reply to the frame
+        message, received = result or (None, None)
+        self.framesProcessed += 1
+        VideoServer.totalFramesProcessed += 1
+        self.releaseData(self.frameBuffer)
+        self.frameBuffer = None
+        if self.closed:
+            self.setBusy(False)
+            return
+
+        # #################################################
+        # Try sending the reply back to the client
+        try:
+            if (message is not None):
+                start = time.time()
+                self.sendMessage( message )
+                self.recordSince('send', start)
+                self.recordSince('latency', received)
             else:
-                # Neither None nor !None... no image in the first place!
-                print self.address, 'ERROR: Could not find an image to process!  '+ str(time.clock())
+                print self.address, 'ERROR: Something went wrong, NOT sending any reply. '+ str(time.clock())
 
-            #########################################
-            # Encode image to send it back
-            if (procImg != None):
-                ## STEP C
-                retval, encImg = eyeDetector.encodeImage(procImg)
+        except Exception as n:
+            print n
 
-                if False == retval:
-                    print self.address, ('ERROR: Could not encode image!'+ str(time.clock()))
-                else:
-                    encImg = base64.b64encode(encImg)
+        if self.pendingFrame is not None:
+            self.processPendingFrame()
+        else:
+            self.setBusy(False)
+
+    ##############################################################################################
+    def submitFrame(self, frame, frameId, received):
+        ## processFrame with --detectors: the detection, drawing and encoding run in a detector process,
+        ## detectionDone builds the reply when it is done. Cache hits and predicted coordinates are answered right away
+        start = time.time()
+        message = None
+        try:
+            img = np.asarray(frame)
+            if self.profile is None:
+                self.chooseProfile(img)
+
+            cached = self.lookupCache(frame) if self.profile is not None else None
+            if self.profile is None:
+                ## ?profile=auto and the frame does not decode, there is no profile to send it with
+                print self.address, 'ERROR: Could not decode image. System time: '+ str(time.clock())
+            elif cached is not None:
+                message = self.cachedReply(img, frameId, cached, received)
             else:
-                print self.address, 'ERROR: Could not find an image to encode!'
+                flags = 0
+                if self.trackMode == 'eyes':
+                    flags |= detectorPool.TRACK_EYES
+                if self.gateMode == 'on':
+                    flags |= detectorPool.MOTION_GATE
+
+                prediction = self.scheduledPrediction(received)
+                faceBox, eyeBoxes = None, []
+                if prediction is not None:
+                    if self.replyMode == 'coords':
+                        message = self.coordsMessage(frameId, *prediction)
+                    flags |= detectorPool.DRAW_ONLY
+                    faceBox, eyeBoxes = prediction[2:]
+
+                if message is None:
+                    done = lambda slot: self.detectionDone(slot, frameId, received, start, prediction)
+                    operation = self.detectorOperations[self.replyMode]
+                    if VideoServer.detectors.submit(self.detectorId, frame, operation, flags, self.profile, faceBox, eyeBoxes, done):
+                        ## The frame is in the slot now, the receive buffer can take the next ones
+                        self.releaseData(self.frameBuffer)
+                        self.frameBuffer = None
+                        return
+                    print self.address, 'ERROR: Frame refused by the detectors (too large, no free slot or every detector gone). System time: ' + str(time.clock())
 
         except Exception as n:
             print 'OpenCV catch fail' + str(n)
 
-        # #################################################
-        # Try sending the frame back to the client
+        self.recordSince('frame', start)
+        self.frameDone((message, received))
+
+    def detectionDone(self, slot, frameId, received, start, prediction):
+        ## Back on the server thread with the result of a frame of submitFrame, still in the slot of the detector pool
+        ## The reply is built and sent before returning, the slot is reused afterwards
+        message = None
         try:
-            if (encImg != None):
-                # eyesX and eyesY are of numpy.int type, which is not json serializable
-                # We get them back to normal python int
-                eyesX = np.asscalar(np.int16(eyesX))
-                eyesY = np.asscalar(np.int16(eyesY))
-                #jsonize all data to send
-                ## If we don't wish to send encImage it should be removed from here
-                out = {'frame': encImg, 'eyesX': eyesX, 'eyesY': eyesY}
-                jsonMessage =  json.dumps(out, default=lambda obj: obj.__dict__)
-                message = encImg
-            else:
-                print self.address, 'ERROR: Something went wrong, NOT sending any image. '+ str(time.clock())
+            (status, eyesX, eyesY, faceBox, eyeBoxes, encImg, seconds) = VideoServer.detectors.result(slot)
+            for stage, spent in zip(('decode', 'detect', 'encode'), seconds):
+                if spent > 0:
+                    self.stats.record(stage, spent)
 
-            self.sendMessage( jsonMessage )
+            if status == detectorPool.DECODE_FAILED:
+                print self.address, 'ERROR: Could not decode image. System time: '+ str(time.clock())
+            elif status == detectorPool.DETECTOR_GONE:
+                print self.address, 'ERROR: Detector process gone with the frame. System time: '+ str(time.clock())
+            elif prediction is not None:
+                eyesX, eyesY, faceBox, eyeBoxes = prediction
+            else:
+                eyesX, eyesY = self.smooth(received, eyesX, eyesY, faceBox, eyeBoxes)
+            if status in (detectorPool.ENCODE_FAILED, detectorPool.REPLY_TOO_LARGE):
+                print self.address, ('ERROR: Could not encode image!'+ str(time.clock()))
+
+            if self.replyMode == 'binary':
+                ## encImg is copied into the outgoing websocket frame by sendMessage, only the cache needs its own copy
+                if encImg is not None and self.cacheKey is not None:
+                    self.cacheResult(encImg.tostring())
+                message = self.binaryMessage(frameId, eyesX, eyesY, faceBox, eyeBoxes, encImg)
+            elif self.replyMode == 'coords':
+                if status == detectorPool.OK:
+                    self.cacheResult(None)
+                    message = self.coordsMessage(frameId, eyesX, eyesY, faceBox, eyeBoxes)
+            elif encImg is not None:
+                encImg = encImg.tostring()
+                self.cacheResult(encImg)
+                message = self.frameMessage(frameId, eyesX, eyesY, encImg)
 
         except Exception as n:
-            print n
+            print 'OpenCV catch fail' + str(n)
+
+        self.recordSince('frame', start)
+        self.frameDone((message, received))
+
+    ##############################################################################################
+    def frameReply(self, img, frameId, received):
+        ## Steps A, B and C, returns the json message with the eye coordinates and the processed image
+        procImg = None ## Image with rectangles around the eyes
+        encImg = None  ## Image encoded in a format suitable to be sent over websocket
+
+        start = time.time()
+        decImg = eyeDetector.decodeImage(img)
+        self.recordSince('decode', start)
+
+        if (decImg is None):
+            print self.address, 'ERROR: Could not decode image. System time: '+ str(time.clock())
+
+        if ( decImg is not None):
+            ## STEP B
+            ## Nothing wrong, detect eyes in the image
+            eyesX, eyesY, faceBox, eyeBoxes = self.detectAndDraw(decImg, received)
+            procImg = decImg
+
+        else:
+            # Neither None nor !None... no image in the first place!
+            print self.address, 'ERROR: Could not find an image to process!  '+ str(time.clock())
+
+        #########################################
+        # Encode image to send it back
+        if (procImg is not None):
+            ## STEP C
+            start = time.time()
+            retval, encImg = eyeDetector.encodeImage(procImg, self.profile)
+            self.recordSince('encode', start)
+
+            if False == retval:
+                print self.address, ('ERROR: Could not encode image!'+ str(time.clock()))
+                encImg = None
+            else:
+                start = time.time()
+                encImg = base64.b64encode(encImg)
+                self.recordSince('base64', start)
+        else:
+            print self.address, 'ERROR: Could not find an image to encode!'
+
+        if (encImg is None):
+            return None
+
+        self.cacheResult(encImg)
+        return self.frameMessage(frameId, eyesX, eyesY, encImg)
+
+    def frameMessage(self, frameId, eyesX, eyesY, encImg):
+        # eyesX and eyesY are of numpy.int type, which is not json serializable
+        # We get them back to normal python int
+        eyesX = np.asscalar(np.int16(eyesX))
+        eyesY = np.asscalar(np.int16(eyesY))
+        #jsonize all data to send
+        start = time.time()
+        out = {'frame': encImg, 'eyesX': eyesX, 'eyesY': eyesY, 'frameId': frameId}
+        if self.scheduler is not None:
+            out['predicted'] = self.predicted
+        jsonMessage = json.dumps(out, default=lambda obj: obj.__dict__)
+        self.recordSince('json', start)
+        return jsonMessage
+
+    ##############################################################################################
+    def coordsReply(self, img, frameId, received):
+        ## Steps A and B only, returns the json message with the eye and face coordinates
+        ## The image is decoded straight to greyscale, nothing is drawn, nothing is encoded (no step C)
+        ## A reply is sent for every frame, eyesX = eyesY = -1 and face = null if nothing was found
+        ## Frames the scheduler does not detect are not even decoded
+        prediction = self.scheduledPrediction(received)
+        if prediction is not None:
+            eyesX, eyesY, faceBox, eyeBoxes = prediction
+        else:
+            start = time.time()
+            gray = eyeDetector.decodeImageGray(img, self.profile)
+            self.recordSince('decode', start)
+            if (gray is None):
+                print self.address, 'ERROR: Could not decode image. System time: '+ str(time.clock())
+                return None
+
+            ## STEP B
+            face, eyes = self.tracker.locateEyes(gray)
+            eyesX, eyesY = eyeDetector.eyesCenter(face, eyes, self.profile)
+            faceBox, eyeBoxes = eyeDetector.imageBoxes(face, eyes, self.profile)
+            eyesX, eyesY = self.smooth(received, eyesX, eyesY, faceBox, eyeBoxes)
+            self.cacheResult(None)
+
+        return self.coordsMessage(frameId, eyesX, eyesY, faceBox, eyeBoxes)
+
+    def coordsMessage(self, frameId, eyesX, eyesY, faceBox, eyeBoxes):
+        start = time.time()
+        out = {'eyesX': int(eyesX), 'eyesY': int(eyesY), 'face': faceBox, 'eyes': eyeBoxes, 'frameId': frameId}
+        if self.scheduler is not None:
+            out['predicted'] = self.predicted
+        jsonMessage = json.dumps(out)
+        self.recordSince('json', start)
+        return jsonMessage
+
+    ##############################################################################################
+    def binaryReply(self, img, frameId, received):
+        ## Steps A, B and C, returns the binary message: [header, jpeg image]
+        ## Only the header if the image could not be decoded or encoded, a reply is sent for every frame
+        ## The jpeg is not copied here, it is only copied once into the outgoing websocket frame
+        eyesX, eyesY, faceBox, eyeBoxes = -1, -1, None, []
+        encImg = None
+
+        start = time.time()
+        decImg = eyeDetector.decodeImage(img)
+        self.recordSince('decode', start)
+        if (decImg is None):
+            print self.address, 'ERROR: Could not decode image. System time: '+ str(time.clock())
+        else:
+            ## STEP B
+            eyesX, eyesY, faceBox, eyeBoxes = self.detectAndDraw(decImg, received)
+
+            ## STEP C
+            start = time.time()
+            retval, encImg = eyeDetector.encodeImage(decImg, self.profile)
+            self.recordSince('encode', start)
+            if False == retval:
+                print self.address, ('ERROR: Could not encode image!'+ str(time.clock()))
+                encImg = None
+            else:
+                self.cacheResult(encImg)
+
+        return self.binaryMessage(frameId, eyesX, eyesY, faceBox, eyeBoxes, encImg)
+
+    def binaryMessage(self, frameId, eyesX, eyesY, faceBox, eyeBoxes, encImg):
+        boxes = (faceBox or [-1]*4) + (sum(eyeBoxes, []) or [-1]*8)
+
+        flags = 0
+        if encImg is not None:
+            flags |= 1
+        if self.scheduler is not None and self.predicted:
+            flags |= 2
+        header = self.binaryHeader.pack(self.binaryVersion, flags, frameId, eyesX, eyesY, *boxes)
+
+        if encImg is None:
+            return [header]
+        return [header, encImg]
+
+    ##############################################################################################
+    def lookupCache(self, frame):
+        ## Same bytes, same profile, same reply mode and same tracker options: same detection
+        ## Returns the cached result of frame, None if there is none. Sets the key cacheResult uses
+        self.cacheKey = None
+        self.detection = None
+        if VideoServer.cache is None:
+            return None
+        self.cacheKey = VideoServer.cache.key(frame, self.replyMode, self.profile, self.trackMode, self.gateMode)
+        cached = VideoServer.cache.get(self.cacheKey)
+        self.stats.count('cacheMisses' if cached is None else 'cacheHits')
+        if cached is not None:
+            self.predicted = False
+        return cached
+
+    def cacheResult(self, encImg):
+        ## Keeps the detection of the frame being processed for its duplicates, as detected: the cache is shared
+        ## by every connection, the coordinates smoothed by the scheduler of one of them are not for the others
+        ## Nothing is kept for predicted frames, they were not detected
+        ## encImg: the encoded image of the reply (base64 or raw jpeg), None for ?reply=coords
+        if self.cacheKey is None or self.detection is None:
+            return
+        if not VideoServer.cacheImages:
+            encImg = None
+        size = len(encImg) if encImg is not None else 0
+        VideoServer.cache.put(self.cacheKey, self.detection + (encImg,), size)
+
+    def cachedReply(self, img, frameId, cached, received):
+        ## Reply to a duplicate frame from the cached result, a detection of the frame for the scheduler too
+        ## Without cacheImages the image still has to be decoded, drawn and encoded, only the detection is saved
+        (eyesX, eyesY, faceBox, eyeBoxes, encImg) = cached
+        eyesX, eyesY = self.smooth(received, eyesX, eyesY, faceBox, eyeBoxes)
+        if self.replyMode == 'coords':
+            return self.coordsMessage(frameId, eyesX, eyesY, faceBox, eyeBoxes)
+
+        if encImg is None:
+            start = time.time()
+            decImg = eyeDetector.decodeImage(img)
+            self.recordSince('decode', start)
+            if decImg is not None:
+                eyeDetector.drawBoxes(decImg, faceBox, eyeBoxes)
+                start = time.time()
+                retval, encImg = eyeDetector.encodeImage(decImg, self.profile)
+                self.recordSince('encode', start)
+                if False == retval:
+                    encImg = None
+            if encImg is not None and self.replyMode == 'frame':
+                start = time.time()
+                encImg = base64.b64encode(encImg)
+                self.recordSince('base64', start)
+
+        if self.replyMode == 'binary':
+            return self.binaryMessage(frameId, eyesX, eyesY, faceBox, eyeBoxes, encImg)
+        if encImg is None:
+            return None
+        return self.frameMessage(frameId, eyesX, eyesY, encImg)
+
+    ##############################################################################################
+    def detectAndDraw(self, decImg, received):
+        ## STEP B on the decoded color image, with the rectangles around the face and the eyes drawn in it
+        ## Returns eyesX, eyesY, faceBox, eyeBoxes in image coordinates, predicted if the scheduler says so
+        prediction = self.scheduledPrediction(received)
+        if prediction is not None:
+            eyeDetector.drawBoxes(decImg, prediction[2], prediction[3])
+            return prediction
+
+        start = time.time()
+        gray = eyeDetector.prepareImage(decImg, self.profile)
+        self.recordSince('prepare', start)
+
+        ## The tracker follows the face of this client from one frame to the next
+        face, eyes = self.tracker.locateEyes(gray)
+
+        start = time.time()
+        eyeDetector.drawDetection(decImg, face, eyes, self.profile)
+        self.recordSince('draw', start)
+
+        eyesX, eyesY = eyeDetector.eyesCenter(face, eyes, self.profile)
+        faceBox, eyeBoxes = eyeDetector.imageBoxes(face, eyes, self.profile)
+        eyesX, eyesY = self.smooth(received, eyesX, eyesY, faceBox, eyeBoxes)
+        return eyesX, eyesY, faceBox, eyeBoxes
+
+    ##############################################################################################
+    def scheduledPrediction(self, received):
+        ## With ?schedule=adaptive, returns the predicted eyesX, eyesY, faceBox, eyeBoxes of a frame the scheduler skips
+        ## None when the frame has to be detected
+        self.predicted = False
+        if self.scheduler is None or self.scheduler.detectNow(self.serverLoad(), received):
+            return None
+        self.predicted = True
+        self.stats.count('predicted')
+        return self.scheduler.predict(received)
+
+    def smooth(self, received, eyesX, eyesY, faceBox, eyeBoxes):
+        ## Detected coordinates, filtered by the scheduler with ?schedule=adaptive
+        ## The detection itself is kept for cacheResult
+        self.detection = (eyesX, eyesY, faceBox, eyeBoxes)
+        if self.scheduler is None:
+            return eyesX, eyesY
+        return self.scheduler.update(received, eyesX, eyesY, faceBox, eyeBoxes)
+
+    ##############################################################################################
+    def serverLoad(self):
+        ## Other connections with frames being processed or waiting, per worker thread (or detector process)
+        ## 0 when this one is alone, 1 or more when every worker has something to do
+        workers = self.server.workers if VideoServer.detectors is None else VideoServer.detectors.processes
+        return (VideoServer.busyConnections - 1) / float(max(1, workers))
+
+    def setBusy(self, busy):
+        if busy != self.busy:
+            VideoServer.busyConnections += 1 if busy else -1
+            self.busy = busy
+
+    ##############################################################################################
+    def chooseProfile(self, img):
+        ## ?profile=auto: the profile is chosen from the resolution of the first frame of the client
+        ## Only the first frame is decoded twice, the profile then stays the same for the whole connection
+        gray = cv2.imdecode(img, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return
+        (height, width) = gray.shape
+        self.profile = eyeDetector.profileForResolution(width, height)
+        self.tracker.setProfile(self.profile)
+        print self.address, 'Video Server: ' + str(width) + 'x' + str(height) + ' frames, detector profile: ' + self.profile.name
+
+    ##############################################################################################
+    def recordSince(self, stage, start):
+        ## Time spent in stage since start, for this connection and for the whole process
+        self.stats.record(stage, time.time() - start)
+
+    ##############################################################################################
+    def negotiate(self, name, default, allowed):
+        ## Clients choose their options in the query of the websocket url, ws://server:8090/?name=value
+        ## Returns the value chosen by the client for option name, default if none or not allowed
+        value = default
+        if self.request is not None:
+            query = urlparse.parse_qs(urlparse.urlparse(self.request.path).query)
+            value = query.get(name, [default])[0]
+
+        if value not in allowed:
+            print self.address, 'WARNING: Unknown ' + name + ' ' + value + ', using ' + default
+            value = default
+        return value
 
     ##############################################################################################	
     def handleConnected(self):
         ## Incoming websocket connection from a browser
         ## Several connections can be handled at the same time from different browsers
-        print self.address, 'Video Server: Connection received from client at system time: '+ str(time.clock())
+        ## Each of them sends its own video stream, so each of them gets its own eye tracker
+        ## The detector profile is negotiated too, None until the first frame with ?profile=auto
+        profileName = self.negotiate('profile', VideoServer.defaultProfile, tuple(eyeDetector.profiles) + ('auto',))
+        self.profile = eyeDetector.profiles.get(profileName)
+        self.trackMode = self.negotiate('track', 'face', self.trackModes)
+        self.gateMode = self.negotiate('gate', 'on', self.gateModes)
+        self.tracker = eyeDetector.EyeTracker(stats=self.stats, profile=self.profile, trackEyes=(self.trackMode == 'eyes'), motionGate=(self.gateMode == 'on'))
+        self.replyMode = self.negotiate('reply', 'frame', self.replyModes)
+        self.scheduleMode = self.negotiate('schedule', VideoServer.defaultSchedule, self.scheduleModes)
+        self.scheduler = None
+        if self.scheduleMode == 'adaptive':
+            self.scheduler = frameScheduler.FrameScheduler()
+        if VideoServer.detectors is not None:
+            self.detectorId = VideoServer.detectors.connect()
+        print self.address, 'Video Server: Connection received from client at system time: '+ str(time.clock()) + ', reply mode: ' + self.replyMode + ', profile: ' + profileName + ', tracking: ' + self.trackMode + ', schedule: ' + self.scheduleMode
 
     ##############################################################################################
     def handleClose(self):
         ## The client closed the connection with the server
-        print self.address, 'Video Server: Connection closed at system time: '+ str(time.clock())
+        ## A frame may still be processed by a worker, its reply will be dropped
+        self.closed = True
+        self.pendingFrame = None
+        self.pendingBuffer = None
+        if self.detectorId is not None:
+            VideoServer.detectors.disconnect(self.detectorId)
+            self.detectorId = None
+        print self.address, 'Video Server: Connection closed at system time: '+ str(time.clock()) + ', frames received: ' + str(self.framesReceived) + ', dropped: ' + str(self.framesDropped)
+        print self.address, 'Video Server: Connection stats: ' + self.stats.dump()
+        if VideoServer.cache is not None:
+            print self.address, 'Video Server: Result cache: ' + VideoServer.cache.dump()
 
 ##################################################################################################
 if __name__ == "__main__":
@@ -183,20 +726,66 @@ if __name__ == "__main__":
     parser.add_option("--ssl", default=0, type='int', action="store", dest="ssl", help="ssl (1: on, 0: off (default))")
     parser.add_option("--cert", default='./cert.pem', type='string', action="store", dest="cert", help="cert (./cert.pem)")
     parser.add_option("--ver", default=ssl.PROTOCOL_TLSv1, type=int, action="store", dest="ver", help="ssl version")
+    parser.add_option("--stats", default=0, type='int', action="store", dest="stats", help="log the stage timings every STATS seconds (0: never (default))")
+    parser.add_option("--workers", default=0, type='int', action="store", dest="workers", help="detection threads (0: detect on the server thread (default))")
+    parser.add_option("--backend", default='select', type='choice', choices=['select', 'asyncio'], action="store", dest="backend", help="event loop serving the connections: select (default) or asyncio (Python 2: pip install trollius)")
+    parser.add_option("--detectors", default=0, type='int', action="store", dest="detectors", help="detector processes, frames and replies go through shared memory (0: detect in the server process (default))")
+    parser.add_option("--detectorSlots", default=64, type='int', action="store", dest="detectorSlots", help="with --detectors, frames being detected at most (64)")
+    parser.add_option("--slotSize", default=1024, type='int', action="store", dest="slotSize", help="with --detectors, KB of shared memory per frame and its reply (1024)")
+    parser.add_option("--processes", default=1, type='int', action="store", dest="processes", help="server processes sharing the port (1: no extra process (default))")
+    parser.add_option("--reusePort", default=0, type='int', action="store", dest="reusePort", help="with --processes, every process listens on its own SO_REUSEPORT socket (1: on, 0: off (default))")
+    parser.add_option("--profile", default='default', type='choice', choices=sorted(eyeDetector.profiles) + ['auto'], action="store", dest="profile", help="detector profile of the clients that don't ask for one: " + ', '.join(sorted(eyeDetector.profiles)) + ' or auto (default: default)')
+    parser.add_option("--schedule", default='every', type='choice', choices=list(VideoServer.scheduleModes), action="store", dest="schedule", help="frames detected for the clients that don't ask: every (default) or adaptive")
+    parser.add_option("--cache", default=32, type='int', action="store", dest="cache", help="MB of results of recent frames kept for their duplicates (32, 0: no cache)")
+    parser.add_option("--cacheImages", default=1, type='int', action="store", dest="cacheImages", help="cache the encoded images of the replies too (1: on (default), 0: off)")
     (options, args) = parser.parse_args()
+    if options.backend == 'asyncio' and asyncWebSocketServer.asyncio is None:
+        parser.error('--backend asyncio needs asyncio (on Python 2: pip install trollius)')
     cls = VideoServer
-
-    ## If we wish to encode the websocket data stream
-    if options.ssl == 1:
-        server = SimpleSSLWebSocketServer(options.host, options.port, cls, options.cert, options.cert, version=options.ver)
+    cls.defaultProfile = options.profile
+    cls.defaultSchedule = options.schedule
+    cls.cache = resultCache.ResultCache(options.cache*1024*1024) if options.cache > 0 else None
+    cls.cacheImages = options.cacheImages == 1
+
+    def serve(serversocket=None):
+        ## Runs the server in this process, on serversocket if given (--processes)
+        ## The detector processes are forked first, before the server starts its threads
+        if options.detectors > 0:
+            VideoServer.detectors = detectorPool.DetectorPool(options.detectors, options.detectorSlots, options.slotSize*1024)
+
+        ## If we wish to encode the websocket data stream
+        if options.backend == 'asyncio':
+            sslContext = None
+            if options.ssl == 1:
+                sslContext = ssl.SSLContext(options.ver)
+                sslContext.load_cert_chain(options.cert, options.cert)
+            server = asyncWebSocketServer.AsyncWebSocketServer(options.host, options.port, cls, workers=options.workers, serversocket=serversocket, sslContext=sslContext)
+        elif options.ssl == 1:
+            server = SimpleSSLWebSocketServer(options.host, options.port, cls, options.cert, options.cert, version=options.ver, workers=options.workers, serversocket=serversocket)
+        else:
+            server = SimpleWebSocketServer(options.host, options.port, cls, workers=options.workers, serversocket=serversocket)
+
+        if VideoServer.detectors is not None:
+            VideoServer.detectors.attach(server)
+
+        ## Periodic dump of the stage timings of the whole process
+        if options.stats > 0:
+            pipelineStats.dumpEvery(VideoServer.processStats, options.stats)
+
+        ## Handle when shooting this server down
+        ## The server is closed by its own loop, not in the middle of whatever the signal interrupted
+        def close_sig_handler(signal, frame):
+            server.stop()
+
+        ## START the server
+        signal.signal(signal.SIGINT, close_sig_handler)
+        signal.signal(signal.SIGTERM, close_sig_handler)
+        server.serveforever()
+        if VideoServer.detectors is not None:
+            VideoServer.detectors.close()
+
+    if options.processes > 1:
+        ## The cascades are already loaded (import eyeDetector), the worker processes share them
+        preforkServer.PreforkServer(options.processes, serve, options.host, options.port, reusePort=(options.reusePort == 1)).run()
     else:
-        server = SimpleWebSocketServer(options.host, options.port, cls)
-
-    ## Handle when shooting this server down
-    def close_sig_handler(signal, frame):
-        server.close()
-        sys.exit()
-
-    ## START the server
-    signal.signal(signal.SIGINT, close_sig_handler)
-    server.serveforever()
+        serve()